@@ -0,0 +1,152 @@
+# capture.py
+#
+# Raw frame capture: every request/reply pair seen on a bus goes to an
+# append-only binary log, so a decode problem can be replayed exactly.
+# Recording only appends to a memory buffer; a writer thread moves it to
+# disk and rotates the files by size.
+#
+# File: header '<4sHdd' (magic, version, wall clock and monotonic time at
+# creation), then records '<HdBBB' (record length, monotonic time, address,
+# status, request length) followed by the request and the reply bytes.
+
+import asyncio
+import atexit
+import os
+import struct
+import threading
+import time
+import protocol
+import register_map
+from read_planner import split_response
+from rtu_sniffer import covered_windows
+
+MAGIC = b'RTRC'
+VERSION = 1
+FILE_HEADER = struct.Struct('<4sHdd')
+RECORD = struct.Struct('<HdBBB')
+
+STATUS = ('ok', 'timeout', 'short_frame', 'bad_frame')
+
+# Buffered bytes beyond which new records are dropped instead of growing memory
+MAX_PENDING = 4 * 1024 * 1024
+
+def frame_status(reply, addr, count):
+    if not reply:
+        return 1
+    if len(reply) < protocol.response_len(count):
+        return 2
+    return 0 if protocol.validate_response(reply, addr, count) else 3
+
+class CaptureWriter:
+    def __init__(self, directory, max_bytes, keep=4):
+        self.directory = directory
+        self.path = os.path.join(directory, 'capture.bin')
+        self.max_bytes = max_bytes
+        self.keep = keep
+        self.records = 0
+        self.lost = 0
+        self._pending = bytearray()
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._io = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+        # Monotonic times only compare within one run: every start begins a new file
+        if os.path.exists(self.path):
+            self._shift()
+        self._open()
+        threading.Thread(target=self._writer, daemon=True).start()
+        atexit.register(self.flush)
+
+    def _open(self):
+        self._file = open(self.path, 'wb')
+        self._file.write(FILE_HEADER.pack(MAGIC, VERSION, time.time(), time.monotonic()))
+
+    def _shift(self):
+        for n in range(self.keep - 1, 0, -1):
+            older = os.path.join(self.directory, f'capture.{n}.bin')
+            if os.path.exists(older):
+                os.replace(older, os.path.join(self.directory, f'capture.{n + 1}.bin'))
+        os.replace(self.path, os.path.join(self.directory, 'capture.1.bin'))
+
+    def record(self, request, reply, status=None):
+        """Queue one exchange; cheap enough for the poll path, never touches the disk."""
+        addr = request[0]
+        if status is None:
+            status = frame_status(reply, addr, int.from_bytes(request[4:6], 'big'))
+        data = RECORD.pack(RECORD.size + len(request) + len(reply), time.monotonic(), addr, status,
+                           len(request)) + request + reply
+        with self._lock:
+            if len(self._pending) > MAX_PENDING:
+                self.lost += 1
+                return
+            self._pending += data
+            self.records += 1
+        if len(self._pending) > 65536:
+            self._wake.set()
+
+    def _writer(self):
+        while True:
+            self._wake.wait(1.0)
+            self._wake.clear()
+            self.flush()
+
+    def flush(self):
+        with self._lock:
+            data, self._pending = self._pending, bytearray()
+        if not data:
+            return
+        with self._io:
+            try:
+                self._file.write(data)
+                self._file.flush()
+                if self._file.tell() >= self.max_bytes:
+                    self._file.close()
+                    self._shift()
+                    self._open()
+            except OSError as e:
+                print(f"Capture write failed: {e}")
+
+def read_records(path):
+    """Yield (monotonic time, address, status, request, reply) from one capture file."""
+    with open(path, 'rb') as f:
+        header = f.read(FILE_HEADER.size)
+        if len(header) < FILE_HEADER.size or FILE_HEADER.unpack(header)[0] != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        while True:
+            head = f.read(RECORD.size)
+            if len(head) < RECORD.size:
+                return
+            length, t, addr, status, req_len = RECORD.unpack(head)
+            body = f.read(length - RECORD.size)
+            if len(body) < length - RECORD.size:
+                return  # cut short by a crash, the rest is lost
+            yield t, addr, status, body[:req_len], body[req_len:]
+
+async def replay(path, batteries, handle, speed=0):
+    """Feed a capture through handle(index, addr, bufs) like live polling does.
+
+    `batteries` maps Modbus address to battery number; `speed` 0 replays as
+    fast as possible, 1 in real time, 10 ten times faster. Returns the number
+    of replies replayed.
+    """
+    replayed = 0
+    first = started = None
+    for t, addr, status, request, reply in read_records(path):
+        index = batteries.get(addr)
+        if index is None or status != 0 or len(request) != 8 or request[1] != protocol.READ_HOLDING:
+            continue
+        if speed:
+            if first is None:
+                first, started = t, time.monotonic()
+            wait = started + (t - first) / speed - time.monotonic()
+            if wait > 0:
+                await asyncio.sleep(wait)
+        elif replayed % 100 == 0:
+            await asyncio.sleep(0)  # let MQTT and other tasks breathe
+        start = int.from_bytes(request[2:4], 'big')
+        count = int.from_bytes(request[4:6], 'big')
+        parts = covered_windows(register_map.MAP.ranges, start, count)
+        if parts:
+            handle(index, addr, split_response(addr, start, parts, reply, count))
+            replayed += 1
+    return replayed
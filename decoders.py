@@ -0,0 +1,71 @@
+# decoders.py
+#
+# Batch decoding of captured Ritar BMS replies (full Modbus RTU frames:
+# address, function, byte count, registers..., CRC). Many frames of one
+# register window are stacked into a register matrix and every field of
+# the register map becomes one column, scaled in a single vectorised pass.
+# Live replies are decoded one by one through register_map.
+
+import sys
+from array import array
+import register_map
+
+try:
+    import numpy as np
+except ImportError:  # batch decoding falls back to array('H')
+    np = None
+
+# --- Batch decoding of captured frames ---
+def register_matrix(frames, count):
+    """Register payloads of many replies stacked row by row.
+
+    Frames whose length does not match `count` registers are skipped.
+    Returns (rows, matrix): a (rows, count) uint16 NumPy array when NumPy is
+    installed, otherwise a flat row major array('H').
+    """
+    size = 5 + 2 * count
+    payload = b''.join(bytes(memoryview(f)[3:3 + 2 * count]) for f in frames if len(f) == size)
+    rows = len(payload) // (2 * count) if count else 0
+    if np is not None:
+        return rows, np.frombuffer(payload, dtype='>u2').astype(np.uint16).reshape(rows, count)
+    regs = array('H', payload)
+    if sys.byteorder == 'little':
+        regs.byteswap()
+    return rows, regs
+
+def _column(matrix, count, col):
+    # Column of a flat row major array('H')
+    return matrix[col::count]
+
+def decode_window_batch(name, frames):
+    """Columns of every field of one register map window, derived values included.
+
+    NumPy arrays when NumPy is installed, otherwise array('d') columns.
+    Values are scaled but neither rounded nor checked against their limits.
+    """
+    regmap = register_map.MAP
+    window = regmap.windows[name]
+    rows, m = register_matrix(frames, window.count)
+    out = {}
+    for f in window.fields:
+        col = f.register - window.start
+        if np is not None:
+            raw = m[:, col].astype(np.int16) if f.type == 'int16' else m[:, col]
+            out[f.name] = (raw.astype(np.float64) + f.offset) * f.scale + f.bias
+        else:
+            raw = _column(m, window.count, col)
+            if f.type == 'int16':
+                raw = array('h', raw.tobytes())
+            off, scale, bias = f.offset, f.scale, f.bias
+            out[f.name] = array('d', ((r + off) * scale + bias for r in raw))
+    for d in regmap.derived:
+        if all(n in out for n in d.product):
+            columns = [out[n] for n in d.product]
+            if np is not None:
+                out[d.name] = np.prod(columns, axis=0)
+            else:
+                product = array('d', columns[0])
+                for column in columns[1:]:
+                    product = array('d', (a * b for a, b in zip(product, column)))
+                out[d.name] = product
+    return out
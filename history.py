@@ -0,0 +1,265 @@
+# history.py
+#
+# Compact on-disk history per battery: one memory mapped file under /data
+# holding, for every field, a raw sample ring plus 1 minute and 1 hour
+# min/max/mean rollup rings. Appending a sample is O(1) and touches only
+# the mapped pages, the files survive restarts without being loaded.
+
+import math
+import mmap
+import os
+import struct
+import zlib
+
+RESOLUTIONS = {'1m': 60, '1h': 3600}
+ROLLUP_CAPACITY = {'1m': 3 * 24 * 60, '1h': 366 * 24}
+
+MAGIC = b'RTRH'
+VERSION = 3
+FILE_HEADER = struct.Struct('<4sHHII')    # magic, version, field count, raw capacity, CRC32 of the field names
+# bucket start, samples in bucket, bucket min, bucket max, bucket sum, ring head, ring count
+RING_HEADER = struct.Struct('<dIffdII4x')
+
+class Ring:
+    """Fixed capacity time series ring inside a mapped file.
+
+    Raw rings hold (time, value); rollup rings hold (time, min, max, mean,
+    samples) and keep the bucket being filled in their header, so a restart
+    does not lose it.
+    """
+    def __init__(self, buf, offset, capacity, columns, period=None):
+        self.buf = buf
+        self.offset = offset
+        self.capacity = capacity
+        self.period = period
+        pos = offset + RING_HEADER.size
+        self.ts = buf[pos:pos + 8 * capacity].cast('d')
+        pos += 8 * capacity
+        self.cols = []
+        for _ in range(columns):
+            self.cols.append(buf[pos:pos + 4 * capacity].cast('f'))
+            pos += 4 * capacity
+        self.end = pos
+
+    @staticmethod
+    def size(capacity, columns):
+        return RING_HEADER.size + 8 * capacity + 4 * capacity * columns
+
+    def _header(self):
+        return list(RING_HEADER.unpack_from(self.buf, self.offset))
+
+    def append(self, t, *values):
+        h = self._header()
+        slot = (h[5] + h[6]) % self.capacity
+        self.ts[slot] = t
+        for col, v in zip(self.cols, values):
+            col[slot] = v
+        if h[6] < self.capacity:
+            h[6] += 1
+        else:
+            h[5] = (h[5] + 1) % self.capacity
+        RING_HEADER.pack_into(self.buf, self.offset, *h)
+
+    def accumulate(self, t, value):
+        """Fold one sample into the current bucket, closing the previous one."""
+        bucket = t - t % self.period
+        start, n, lo, hi, total, head, count = self._header()
+        if n and bucket != start:
+            self.append(start, lo, hi, total / n, n)
+            head, count = self._header()[5:]
+            n = 0
+        if not n:
+            start, lo, hi, total = bucket, value, value, 0.0
+        n += 1
+        lo = min(lo, value)
+        hi = max(hi, value)
+        total += value
+        RING_HEADER.pack_into(self.buf, self.offset, start, n, lo, hi, total, head, count)
+
+    def newest(self):
+        _, _, _, _, _, head, count = self._header()
+        return self.ts[(head + count - 1) % self.capacity] if count else None
+
+    def current(self):
+        """The bucket still being filled as a rollup row, None when empty."""
+        start, n, lo, hi, total, _, _ = self._header()
+        return [start, round(lo, 3), round(hi, 3), round(total / n, 3), n] if n else None
+
+    def oldest(self):
+        _, _, _, _, _, head, count = self._header()
+        return self.ts[head] if count else None
+
+    def _time_at(self, i, head):
+        return self.ts[(head + i) % self.capacity]
+
+    def _search(self, t, head, count):
+        # First logical index with time >= t, rings are filled in time order
+        lo, hi = 0, count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._time_at(mid, head) < t:
+                lo = mid + 1
+            else:
+                hi = mid
+        return lo
+
+    def rows(self, start, end):
+        _, _, _, _, _, head, count = self._header()
+        first = self._search(start, head, count)
+        last = self._search(end, head, count)
+        # Inclusive end
+        while last < count and self._time_at(last, head) <= end:
+            last += 1
+        out = []
+        for i in range(first, last):
+            slot = (head + i) % self.capacity
+            out.append([self.ts[slot]] + [round(col[slot], 3) for col in self.cols])
+        return out
+
+class BatteryHistory:
+    def __init__(self, path, raw_capacity, fields):
+        self.raw = {}
+        self.rollups = {}
+        size = FILE_HEADER.size + len(fields) * (
+            Ring.size(raw_capacity, 1) + sum(Ring.size(c, 4) for c in ROLLUP_CAPACITY.values()))
+        # A different register map lays out other rings, its files start over
+        signature = zlib.crc32(','.join(fields).encode())
+        header = FILE_HEADER.pack(MAGIC, VERSION, len(fields), raw_capacity, signature)
+        fresh = not os.path.exists(path) or os.path.getsize(path) != size
+        if not fresh:
+            with open(path, 'rb') as f:
+                fresh = f.read(FILE_HEADER.size) != header
+        if fresh:
+            with open(path, 'wb') as f:
+                f.truncate(size)
+                f.write(header)
+        self._file = open(path, 'r+b')
+        self._mm = mmap.mmap(self._file.fileno(), size)
+        buf = memoryview(self._mm)
+        pos = FILE_HEADER.size
+        for field in fields:
+            ring = Ring(buf, pos, raw_capacity, 1)
+            self.raw[field] = ring
+            pos = ring.end
+            for res, period in RESOLUTIONS.items():
+                ring = Ring(buf, pos, ROLLUP_CAPACITY[res], 4, period)
+                self.rollups[(field, res)] = ring
+                pos = ring.end
+        # Latest sample time written, rings must stay in time order
+        self.last = max((ring.newest() or 0.0 for ring in self.raw.values()), default=0.0)
+
+    def add(self, field, t, value):
+        self.raw[field].append(t, value)
+        for res in RESOLUTIONS:
+            self.rollups[(field, res)].accumulate(t, value)
+
+    def flush(self):
+        self._mm.flush()
+
+class HistoryStore:
+    def __init__(self, directory, raw_capacity, fields):
+        self.directory = directory
+        self.raw_capacity = raw_capacity
+        self.fields = list(fields)
+        self.batteries = {}
+        os.makedirs(directory, exist_ok=True)
+
+    def _path(self, index):
+        return os.path.join(self.directory, f'ritar_{index}.hist')
+
+    def has(self, index):
+        return index in self.batteries or os.path.exists(self._path(index))
+
+    def _battery(self, index):
+        hist = self.batteries.get(index)
+        if hist is None:
+            path = self._path(index)
+            hist = self.batteries[index] = BatteryHistory(path, self.raw_capacity, self.fields)
+        return hist
+
+    def record(self, index, t, values):
+        """Append (field, value) pairs of one battery sampled at unix time t.
+
+        A clock stepped back (NTP) would break the time order the ring
+        searches rely on: such samples are stamped with the latest time seen.
+        """
+        hist = self._battery(index)
+        t = hist.last = max(t, hist.last)
+        for field, value in values:
+            if field in hist.raw and isinstance(value, (int, float)) and not math.isnan(value):
+                hist.add(field, t, value)
+
+    def query(self, index, field, start, end, resolution='raw'):
+        """Points in [start, end]: [t, value] raw, [t, min, max, mean, samples] for rollups."""
+        hist = self._battery(index)
+        if field not in hist.raw:
+            raise KeyError(field)
+        ring = hist.raw[field] if resolution == 'raw' else hist.rollups[(field, resolution)]
+        return ring.rows(start, end)
+
+    def aggregate(self, index, field, start, end):
+        """min / max / mean over [start, end] from the finest resolution that covers it.
+
+        `covered` is the time range the samples come from: rollup buckets
+        are whole, the first one may begin before `start`.
+        """
+        rows = self.query(index, field, start, end, 'raw')
+        hist = self._battery(index)
+        oldest = hist.raw[field].oldest()
+        if rows and oldest <= start:
+            values = [r[1] for r in rows]
+            return {'min': min(values), 'max': max(values), 'mean': sum(values) / len(values),
+                    'count': len(values), 'resolution': 'raw', 'covered': [rows[0][0], rows[-1][0]]}
+        for res, period in RESOLUTIONS.items():
+            ring = hist.rollups[(field, res)]
+            # Also the bucket holding `start` and the one still open in the ring header
+            rows = ring.rows(start - start % period, end)
+            current = ring.current()
+            if current and start - start % period <= current[0] <= end:
+                rows.append(current)
+            if rows:
+                # Buckets hold different numbers of samples, weight their means by them
+                samples = sum(r[4] for r in rows)
+                return {'min': min(r[1] for r in rows), 'max': max(r[2] for r in rows),
+                        'mean': sum(r[3] * r[4] for r in rows) / samples, 'count': int(samples),
+                        'resolution': res, 'covered': [rows[0][0], min(end, rows[-1][0] + period)]}
+        return {'min': None, 'max': None, 'mean': None, 'count': 0, 'resolution': None, 'covered': None}
+
+    def flush(self):
+        for hist in self.batteries.values():
+            hist.flush()
+
+# --- Query API (MQTT request / response) ---
+REQUEST_TOPIC = 'ritar_bms/history/get'
+RESULT_TOPIC = 'ritar_bms/history/result'
+
+def answer(store, request, now):
+    """Reply document for one JSON request, e.g.
+    {"battery": 1, "field": "cell_01", "resolution": "1m", "start": <unix>, "end": <unix>}
+    Without start/end the last hour is returned, "aggregate": true gives min/max/mean only.
+    """
+    reply = {'id': request.get('id')}
+    try:
+        index = int(request['battery'])
+        field = request['field']
+        end = float(request.get('end', now))
+        start = float(request.get('start', end - 3600))
+        resolution = request.get('resolution', 'raw')
+        if field not in store.fields:
+            raise ValueError(f"unknown field {field!r}, one of {', '.join(store.fields)}")
+        if resolution != 'raw' and resolution not in RESOLUTIONS:
+            raise ValueError(f"resolution must be raw, {' or '.join(RESOLUTIONS)}")
+        if not store.has(index):
+            raise ValueError(f"no history for battery {index}")
+        reply.update(battery=index, field=field, start=start, end=end)
+        if request.get('aggregate'):
+            reply.update(store.aggregate(index, field, start, end))
+        else:
+            reply['resolution'] = resolution
+            reply['columns'] = ['time', 'value'] if resolution == 'raw' else ['time', 'min', 'max', 'mean', 'samples']
+            reply['points'] = store.query(index, field, start, end, resolution)
+    except KeyError as e:
+        reply['error'] = f"missing {e.args[0]}"
+    except (TypeError, ValueError) as e:
+        reply['error'] = str(e)
+    return reply
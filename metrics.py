@@ -0,0 +1,149 @@
+# metrics.py
+#
+# Cheap in-process instrumentation: per battery / per query latency
+# histograms, error counters, stage timings and bus load. Updating
+# is a dict lookup plus a bisect, rendering happens only when diagnostics
+# are published or the Prometheus endpoint is scraped.
+
+import asyncio
+import bisect
+import time
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+
+# Reasons a battery reading gets lost
+ERRORS = ('timeout', 'short_frame', 'bad_frame', 'out_of_range')
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'total')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.total = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.total += 1
+
+    @property
+    def mean(self):
+        return self.sum / self.total if self.total else None
+
+class Metrics:
+    def __init__(self):
+        self.latency = {}   # (battery, query) -> Histogram
+        self.errors = {}    # battery -> {error: count}
+        self.stages = {}    # stage name -> Histogram
+        self.bus_lag = {}   # bus name -> smoothed scheduling lag (s)
+        self.bus_busy = {}  # bus name -> seconds spent talking to the bus
+        self._busy_mark = {}
+        self.gauges = {}    # name -> callable returning a number
+
+    def query(self, battery, query, elapsed, reply_len, expected_len, valid):
+        hist = self.latency.get((battery, query))
+        if hist is None:
+            hist = self.latency[(battery, query)] = Histogram()
+        hist.observe(elapsed)
+        if not valid:
+            if not reply_len:
+                self.error(battery, 'timeout')
+            elif reply_len < expected_len:
+                self.error(battery, 'short_frame')
+            else:
+                self.error(battery, 'bad_frame')
+
+    def error(self, battery, kind):
+        counts = self.errors.get(battery)
+        if counts is None:
+            counts = self.errors[battery] = dict.fromkeys(ERRORS, 0)
+        counts[kind] += 1
+
+    def stage(self, name, elapsed):
+        hist = self.stages.get(name)
+        if hist is None:
+            hist = self.stages[name] = Histogram()
+        hist.observe(elapsed)
+
+    def lag(self, bus, seconds):
+        # How late scheduled queries start; grows when the bus is overbooked
+        old = self.bus_lag.get(bus)
+        self.bus_lag[bus] = seconds if old is None else 0.9 * old + 0.1 * seconds
+
+    def busy(self, bus, seconds):
+        self.bus_busy[bus] = self.bus_busy.get(bus, 0.0) + seconds
+
+    def utilisation(self, bus):
+        """Busy fraction of the bus since the previous call."""
+        now = time.monotonic()
+        busy = self.bus_busy.get(bus, 0.0)
+        last_now, last_busy = self._busy_mark.get(bus, (None, 0.0))
+        self._busy_mark[bus] = (now, busy)
+        if last_now is None or now <= last_now:
+            return None
+        return (busy - last_busy) / (now - last_now)
+
+    def battery_summary(self, battery):
+        """Mean query latency (ms), query count and error counters of one battery."""
+        total = count = 0
+        # Snapshots: poll threads add keys while the loop thread reads
+        for (b, _), hist in list(self.latency.items()):
+            if b == battery:
+                total += hist.sum
+                count += hist.total
+        summary = dict(self.errors.get(battery) or dict.fromkeys(ERRORS, 0))
+        summary['queries'] = count
+        summary['latency'] = round(total / count * 1000, 1) if count else None
+        return summary
+
+    def prometheus(self):
+        """Prometheus text exposition format."""
+        lines = ['# TYPE ritar_query_latency_seconds histogram']
+        for (battery, query), hist in sorted(list(self.latency.items())):
+            labels = f'battery="{battery}",query="{query}"'
+            cumulative = 0
+            for bound, n in zip(LATENCY_BUCKETS + ('+Inf',), hist.counts):
+                cumulative += n
+                lines.append(f'ritar_query_latency_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'ritar_query_latency_seconds_sum{{{labels}}} {hist.sum:.6f}')
+            lines.append(f'ritar_query_latency_seconds_count{{{labels}}} {hist.total}')
+        lines.append('# TYPE ritar_errors_total counter')
+        for battery, counts in sorted(list(self.errors.items())):
+            for kind, n in counts.items():
+                lines.append(f'ritar_errors_total{{battery="{battery}",kind="{kind}"}} {n}')
+        lines.append('# TYPE ritar_stage_seconds summary')
+        for name, hist in sorted(list(self.stages.items())):
+            lines.append(f'ritar_stage_seconds_sum{{stage="{name}"}} {hist.sum:.6f}')
+            lines.append(f'ritar_stage_seconds_count{{stage="{name}"}} {hist.total}')
+        lines.append('# TYPE ritar_bus_lag_seconds gauge')
+        for bus, lag in sorted(list(self.bus_lag.items())):
+            lines.append(f'ritar_bus_lag_seconds{{bus="{bus}"}} {lag:.6f}')
+        lines.append('# TYPE ritar_bus_busy_seconds_total counter')
+        for bus, busy in sorted(list(self.bus_busy.items())):
+            lines.append(f'ritar_bus_busy_seconds_total{{bus="{bus}"}} {busy:.6f}')
+        for name, read in sorted(list(self.gauges.items())):
+            lines.append(f'# TYPE ritar_{name} gauge')
+            lines.append(f'ritar_{name} {read()}')
+        return '\n'.join(lines) + '\n'
+
+metrics = Metrics()
+
+async def serve_prometheus(port, host='0.0.0.0'):
+    """Tiny HTTP endpoint answering every GET with the current metrics."""
+    async def client(reader, writer):
+        try:
+            await reader.readuntil(b'\r\n\r\n')
+            body = metrics.prometheus().encode()
+            writer.write(b'HTTP/1.1 200 OK\r\n'
+                         b'Content-Type: text/plain; version=0.0.4\r\n'
+                         b'Content-Length: ' + str(len(body)).encode() + b'\r\n'
+                         b'Connection: close\r\n\r\n' + body)
+            await writer.drain()
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    server = await asyncio.start_server(client, host, port)
+    async with server:
+        await server.serve_forever()
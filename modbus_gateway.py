@@ -1,8 +1,41 @@
 # modbus_gateway.py
 
+import random
+import select
 import socket
+import termios
+import time
 import serial  # from pyserial
 
+class Backoff:
+    """Jittered exponential backoff with a simple circuit breaker.
+
+    After `threshold` consecutive failures the breaker opens and attempts are
+    refused until the current delay has passed.
+    """
+    def __init__(self, base=1.0, cap=60.0, threshold=3):
+        self.base = base
+        self.cap = cap
+        self.threshold = threshold
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def ready(self, now=None):
+        return (now or time.monotonic()) >= self.retry_at
+
+    def success(self):
+        self.failures = 0
+        self.retry_at = 0.0
+
+    def failure(self, now=None):
+        self.failures += 1
+        if self.failures < self.threshold:
+            return 0.0
+        delay = min(self.cap, self.base * 2 ** (self.failures - self.threshold))
+        delay *= random.uniform(0.5, 1.0)
+        self.retry_at = (now or time.monotonic()) + delay
+        return delay
+
 class ModbusGateway:
     def __init__(self, cfg):
         self.type = cfg['connection_type']
@@ -18,11 +51,23 @@ class ModbusGateway:
             self._serial = None
         else:
             raise ValueError(f"Unknown connection type: {self.type}")
+        # RS485 side timing: 11 bits per character, 3.5 characters of silence between frames
+        self.char_time = 11.0 / cfg.get('serial_baudrate', 9600)
+        self.silence = max(3.5 * self.char_time, 0.00175)
+        self.turnaround = None
+        self._last_rx = 0.0
+        self.capture = None  # CaptureWriter recording every exchange, if enabled
+        self.persistent = cfg.get('persistent_connection', True)
+        self.backoff = Backoff(
+            base=cfg.get('reconnect_min_delay', 1),
+            cap=cfg.get('reconnect_max_delay', 60)
+        )
 
     def open(self):
         if self.type == 'ethernet':
             self._sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self._sock.settimeout(self.timeout)
+            self._set_keepalive(self._sock)
             self._sock.connect((self.host, self.port))
         else:
             self._serial = serial.Serial(
@@ -34,18 +79,162 @@ class ModbusGateway:
     def close(self):
         if self.type == 'ethernet' and self._sock:
             self._sock.close()
+            self._sock = None
         elif self.type == 'serial' and self._serial:
             self._serial.close()
+            self._serial = None
+
+    @property
+    def is_open(self):
+        if self.type == 'ethernet':
+            return self._sock is not None
+        return self._serial is not None and self._serial.is_open
+
+    # --- Long-lived connection handling ---
+    def acquire(self, drain=True):
+        """Make sure the link is usable for a polling cycle.
+
+        Reuses a healthy persistent connection, otherwise (re)connects unless
+        the circuit breaker is open. Returns False when the gateway should be
+        left alone for now. Listen-only mode passes drain=False: waiting bytes
+        are traffic to decode, a closed peer shows up on the next read.
+        """
+        if self.is_open and (not drain or self.healthy()):
+            return True
+        self.close()
+        if not self.backoff.ready():
+            return False
+        try:
+            self.open()
+        except OSError as e:
+            self.close()
+            delay = self.backoff.failure()
+            print(f"Gateway connect failed: {e}" + (f", retry in {delay:.1f}s" if delay else ""))
+            return False
+        self.backoff.success()
+        return True
+
+    def release(self):
+        if not self.persistent:
+            self.close()
+
+    def fail(self, error):
+        """Drop a connection that broke mid-cycle; the next acquire() reconnects."""
+        print(f"Gateway connection lost: {error}")
+        self.close()
+        self.backoff.failure()
+
+    def healthy(self):
+        """Detect a half-closed socket and drop stale bytes left by a late reply."""
+        if self.type == 'serial':
+            try:
+                if self._serial.in_waiting:
+                    self._serial.reset_input_buffer()
+            except (OSError, termios.error):
+                return False  # adapter unplugged
+            return True
+        try:
+            while select.select([self._sock], [], [], 0)[0]:
+                if not self._sock.recv(4096):
+                    return False  # peer closed its side
+        except OSError:
+            return False
+        return True
+
+    @staticmethod
+    def _set_keepalive(sock):
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        for opt, value in (('TCP_KEEPIDLE', 30), ('TCP_KEEPINTVL', 10), ('TCP_KEEPCNT', 3)):
+            if hasattr(socket, opt):
+                sock.setsockopt(socket.IPPROTO_TCP, getattr(socket, opt), value)
+
+    # --- Framed request/response ---
+    def request(self, frame: bytes, size: int, timeout: float = None) -> bytes:
+        """Send one query and return its reply frame, short or empty on timeout.
+
+        `timeout` shortens the reply deadline, e.g. when probing for batteries.
+        """
+        wait = self._last_rx + self.silence - time.monotonic()
+        if wait > 0:
+            time.sleep(wait)
+        self._drain()
+        start = time.monotonic()
+        self.send(frame)
+        deadline = self._deadline(len(frame) + size)
+        if timeout is not None:
+            deadline = min(deadline, timeout)
+        reply = self.read_frame(start + deadline)
+        self._last_rx = time.monotonic()
+        if self.capture is not None:
+            self.capture.record(frame, reply)
+        if len(reply) == size:
+            sample = max(0.0, self._last_rx - start - self.char_time * (len(frame) + size))
+            self.turnaround = sample if self.turnaround is None else 0.8 * self.turnaround + 0.2 * sample
+        return reply
+
+    def read_frame(self, deadline):
+        """Accumulate bytes until the frame announced by its byte count field is complete."""
+        buf = bytearray()
+        need = 3
+        while len(buf) < need:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            chunk = self._read_some(need - len(buf), remaining)
+            if not chunk:
+                break
+            buf += chunk
+            if need == 3 and len(buf) >= 3:
+                # Exception replies carry a one byte code instead of a byte count
+                need = 5 if buf[1] & 0x80 else 5 + buf[2]
+        return bytes(buf)
+
+    def listen(self, timeout):
+        """Listen-only mode: whatever bytes the bus carries next, b'' after `timeout` of silence."""
+        if self.type == 'ethernet':
+            return self._read_some(4096, timeout)
+        self._serial.timeout = timeout
+        data = self._serial.read(1)
+        if data and self._serial.in_waiting:
+            data += self._serial.read(self._serial.in_waiting)
+        return data
+
+    def _deadline(self, wire_chars):
+        # Learn the real turnaround, but never wait longer than the configured timeout
+        if self.turnaround is None:
+            return self.timeout
+        return min(self.timeout, max(0.5, 4 * self.turnaround) + 2 * self.char_time * wire_chars)
+
+    def _read_some(self, size, timeout):
+        if self.type == 'ethernet':
+            self._sock.settimeout(timeout)
+            return self.recv(size)
+        self._serial.timeout = timeout
+        return self._serial.read(size)
+
+    def _drain(self):
+        # A reply that arrived after its deadline must not be taken for the next one
+        if self.type == 'serial':
+            if self._serial.in_waiting:
+                self._serial.reset_input_buffer()
+        elif select.select([self._sock], [], [], 0)[0]:
+            self._sock.recv(4096)
 
     def send(self, data: bytes):
         if self.type == 'ethernet':
-            self._sock.send(data)
+            self._sock.sendall(data)
         else:
             # Some serial gateways need a CRC or a header; adjust as needed
             self._serial.write(data)
 
     def recv(self, size: int) -> bytes:
         if self.type == 'ethernet':
-            return self._sock.recv(size)
+            try:
+                data = self._sock.recv(size)
+            except socket.timeout:
+                return b''  # silent slave, same as a short serial read
+            if not data:
+                raise ConnectionResetError("gateway closed the connection")
+            return data
         else:
             return self._serial.read(size)
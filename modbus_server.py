@@ -0,0 +1,108 @@
+# modbus_server.py
+#
+# Modbus TCP server (function 0x03) answering from the register image the
+# add-on keeps while polling, so an inverter or the vendor tool can read the
+# batteries without a second master on the RS485 bus. Registers older than
+# the staleness limit are fetched on demand through the owning bus, where
+# the read is merged with the scheduled one covering the same registers.
+
+import asyncio
+import time
+from array import array
+import protocol
+
+# Registers kept per battery, every known window lies below 0x100
+IMAGE_REGS = 256
+
+# Modbus exception codes
+ILLEGAL_FUNCTION = 0x01
+ILLEGAL_ADDRESS = 0x02
+TARGET_FAILED = 0x0B
+
+class RegisterImage:
+    """Last known holding registers per battery with a read time per register."""
+    def __init__(self):
+        self.regs = {}    # battery -> bytearray, big endian registers
+        self.stamps = {}  # battery -> array of monotonic read times, 0 = never read
+
+    def store(self, battery, start, reply, now=None):
+        """Copy a validated function 0x03 reply for registers start.. into the image."""
+        count = reply[2] // 2
+        if start + count > IMAGE_REGS:
+            return
+        regs = self.regs.get(battery)
+        if regs is None:
+            regs = self.regs[battery] = bytearray(2 * IMAGE_REGS)
+            self.stamps[battery] = array('d', bytes(8 * IMAGE_REGS))
+        regs[2 * start:2 * (start + count)] = reply[3:3 + 2 * count]
+        stamp = time.monotonic() if now is None else now
+        stamps = self.stamps[battery]
+        for r in range(start, start + count):
+            stamps[r] = stamp
+
+    def age(self, battery, start, count, now=None):
+        """Seconds since the oldest of the registers was read, None if one never was."""
+        stamps = self.stamps.get(battery)
+        if stamps is None:
+            return None
+        oldest = min(stamps[start:start + count])
+        if not oldest:
+            return None
+        return (time.monotonic() if now is None else now) - oldest
+
+    def read(self, battery, start, count):
+        return bytes(self.regs[battery][2 * start:2 * (start + count)])
+
+def unit_id(index):
+    """Battery number as Modbus TCP unit id, battery 16 answers as unit 0 like on the bus."""
+    return protocol.battery_address(index) if index <= 16 else index
+
+def exception_pdu(func, code):
+    return bytes((func | 0x80, code))
+
+async def answer(image, units, max_age, unit, pdu):
+    """Response PDU for one request PDU addressed to `unit`."""
+    func = pdu[0]
+    if func != protocol.READ_HOLDING:
+        return exception_pdu(func, ILLEGAL_FUNCTION)
+    if len(pdu) != 5:
+        return exception_pdu(func, ILLEGAL_ADDRESS)
+    start = int.from_bytes(pdu[1:3], 'big')
+    count = int.from_bytes(pdu[3:5], 'big')
+    if not 1 <= count <= 125 or start + count > IMAGE_REGS:
+        return exception_pdu(func, ILLEGAL_ADDRESS)
+    target = units.get(unit)
+    if target is None:
+        return exception_pdu(func, TARGET_FAILED)
+    bus, index, addr = target
+    age = image.age(index, start, count)
+    if age is None or age > max_age:
+        asked = time.monotonic()
+        await bus.demand_read(index, addr, start, count)
+        # Registers read since the request arrived are fresh however long the bus took
+        age = image.age(index, start, count)
+        if age is None or age > max(max_age, time.monotonic() - asked):
+            return exception_pdu(func, TARGET_FAILED)
+    return bytes((func, 2 * count)) + image.read(index, start, count)
+
+async def serve_modbus(image, buses, max_age, port, host='0.0.0.0'):
+    """Modbus TCP (MBAP framed) server, every connection may pipeline requests."""
+    units = {unit_id(index): (bus, index, addr) for bus in buses for index, addr in bus.batteries}
+    async def client(reader, writer):
+        try:
+            while True:
+                header = await reader.readexactly(7)
+                length = int.from_bytes(header[4:6], 'big')
+                if header[2:4] != b'\x00\x00' or not 2 <= length <= 254:
+                    break
+                pdu = await reader.readexactly(length - 1)
+                reply = await answer(image, units, max_age, header[6], pdu)
+                writer.write(header[:4] + (len(reply) + 1).to_bytes(2, 'big') + header[6:7] + reply)
+                await writer.drain()
+        except (asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+    server = await asyncio.start_server(client, host, port)
+    async with server:
+        await server.serve_forever()
@@ -0,0 +1,123 @@
+# mqtt_queue.py
+#
+# MQTT publishing as its own stage: the poll loop only puts messages into a
+# bounded queue keyed by topic, a newer value replacing one not sent yet,
+# and a worker thread hands them to paho in batches while the broker is
+# connected. A slow or reconnecting broker therefore never holds up the bus,
+# it only makes intermediate values of the same topic disappear.
+
+import threading
+import time
+from collections import OrderedDict
+
+# (QoS, retain) per message kind
+POLICY = {
+    'config': (1, True),       # discovery configs, must not get lost
+    'state': (0, True),        # sensor states, the next one follows soon
+    'diagnostic': (0, True),   # add-on and per battery counters
+    'reply': (1, False),       # answers to requests (history)
+}
+
+MQTT_ERR_NO_CONN = 4  # paho: not connected, a QoS 1 message stays queued in paho for the reconnect
+
+class PublishQueue:
+    def __init__(self, client, max_topics=4096, batch=200, linger=0.05, max_inflight=200):
+        """`linger` is how long the worker waits for more messages of the same
+        poll cycle before a batch; at most `max_inflight` messages are handed to
+        paho and not reported written out (on_publish) at any time.
+        """
+        self.client = client
+        self.max_topics = max_topics
+        self.batch = batch
+        self.linger = linger
+        self.max_inflight = max_inflight
+        self.connected = False
+        self.sent = 0
+        self.coalesced = 0
+        self.dropped = 0
+        self._pending = OrderedDict()  # topic -> (payload, qos, retain)
+        self._inflight = {}            # mid -> qos, written to paho but not out yet
+        self._early = set()            # mids reported out before publish() returned
+        self.on_drop = None            # called with the topic of a message dropped on a full queue
+        self._cond = threading.Condition()
+        threading.Thread(target=self._worker, daemon=True).start()
+
+    def put(self, topic, payload, kind='state'):
+        """Queue a message, never blocks; an unsent message of the same topic is replaced."""
+        qos, retain = POLICY[kind]
+        with self._cond:
+            if topic in self._pending:
+                self.coalesced += 1
+            elif len(self._pending) >= self.max_topics:
+                self._evict()
+            self._pending[topic] = (payload, qos, retain)
+            self._cond.notify()
+
+    def _evict(self):
+        # The oldest state or diagnostic goes first, its next value follows soon
+        victim = next((t for t, (_, qos, _) in self._pending.items() if not qos), None)
+        if victim is None:
+            victim = next(iter(self._pending))
+        del self._pending[victim]
+        self.dropped += 1
+        if self.on_drop is not None:
+            self.on_drop(victim)
+
+    def backlog(self):
+        return len(self._pending) + len(self._inflight)
+
+    # paho callbacks, called on its network thread
+    def on_connect(self):
+        with self._cond:
+            self.connected = True
+            self._cond.notify()
+
+    def on_disconnect(self):
+        with self._cond:
+            self.connected = False
+            # QoS 0 messages paho had not written out are gone, QoS 1 ones are resent
+            self._inflight = {mid: qos for mid, qos in self._inflight.items() if qos}
+            self._early.clear()
+            self._cond.notify()
+
+    def on_publish(self, mid):
+        with self._cond:
+            if self._inflight.pop(mid, None) is not None:
+                self._cond.notify()
+            else:
+                self._early.add(mid)
+
+    def _ready(self):
+        return self.connected and self._pending and len(self._inflight) < self.max_inflight
+
+    def _worker(self):
+        while True:
+            with self._cond:
+                while not self._ready():
+                    self._cond.wait()
+            # Let the rest of the poll cycle arrive, so a batch goes out together
+            time.sleep(self.linger)
+            with self._cond:
+                room = min(self.batch, self.max_inflight - len(self._inflight))
+                batch = []
+                while self._pending and len(batch) < room:
+                    batch.append(self._pending.popitem(last=False))
+            for n, (topic, (payload, qos, retain)) in enumerate(batch):
+                info = self.client.publish(topic, payload, qos=qos, retain=retain)
+                accepted = not info.rc or (qos and info.rc == MQTT_ERR_NO_CONN)
+                if accepted:
+                    with self._cond:
+                        if info.mid in self._early:
+                            self._early.discard(info.mid)
+                        else:
+                            self._inflight[info.mid] = qos
+                        self.sent += 1
+                if info.rc:
+                    # Lost the connection midway: requeue what paho did not take unless newer values came
+                    with self._cond:
+                        self.connected = self.client.is_connected()
+                        for topic, message in reversed(batch[n + 1 if accepted else n:]):
+                            if topic not in self._pending:
+                                self._pending[topic] = message
+                                self._pending.move_to_end(topic, last=False)
+                    break
@@ -0,0 +1,329 @@
+# poll_engine.py
+#
+# asyncio polling engine: one coroutine per RS485 bus / gateway. Queries on a
+# bus stay strictly sequential (the blocking ModbusGateway runs in a worker
+# thread), different buses run side by side, and every reply is handed to a
+# single decode/publish callback on the event loop thread.
+#
+# Each bus runs a deadline scheduler: a heap of (next due time, battery,
+# query class) where every class has its own polling interval, so pack
+# current can be read every few seconds while temperatures are read rarely.
+# On-demand reads (Modbus TCP clients) jump the queue; when a scheduled class
+# covers the registers it is run early instead of reading the bus twice.
+#
+# In listen-only (sniff) mode a bus sends nothing: another master polls the
+# batteries and the replies it gets are decoded instead.
+#
+# A battery that stops answering leaves the schedule and is re-probed with a
+# short timeout and exponential backoff while the bus is idle; with discovery
+# every address starts out that way, so startup is a scan of the bus.
+
+import asyncio
+import heapq
+import time
+import protocol
+import register_map
+from modbus_gateway import ModbusGateway, Backoff
+from read_planner import build_reads, split_response
+from rtu_sniffer import RtuParser, covered_windows
+from metrics import metrics
+
+# Consecutive unanswered query class reads before a battery leaves the schedule
+DEAD_AFTER = 3
+# Re-probe delays of a silent address (seconds)
+PROBE_MIN_DELAY = 10
+PROBE_MAX_DELAY = 600
+
+def poll_battery(gateway, index, addr, battery_reads, queries_delay, image=None):
+    bufs = {}
+    windows = register_map.MAP.windows
+    for frame, size, start, parts in battery_reads:
+        # Windows marked only_after are only worth asking for after a good reply of that window
+        after = [windows[name].only_after for name, _, _ in parts]
+        if None not in after and all(w in bufs and not bufs[w] for w in after):
+            continue
+        if queries_delay:
+            time.sleep(queries_delay)
+        sent = time.perf_counter()
+        reply = gateway.request(frame, size)
+        elapsed = time.perf_counter() - sent
+        decoded = split_response(addr, start, parts, reply)
+        valid = decoded[parts[0][0]] is not None
+        metrics.query(index, '+'.join(p[0] for p in parts), elapsed, len(reply), size, valid)
+        if valid and image is not None:
+            image.store(index, start, reply)
+        bufs.update(decoded)
+    return bufs
+
+class Bus:
+    def __init__(self, name, cfg, indexes, classes, queries_delay=0, next_battery_delay=0,
+                 duty_cycle=1.0, discover=False, probe_timeout=0.5):
+        """`classes` is a list of (interval seconds, read plan) query classes.
+
+        With `discover` no battery is polled before it answered a probe.
+        """
+        self.name = name
+        self.cfg = cfg
+        self.gateway = ModbusGateway(cfg)
+        self.queries_delay = queries_delay
+        self.next_battery_delay = next_battery_delay
+        self.duty_cycle = duty_cycle
+        self.classes = classes
+        self.image = None  # RegisterImage fed by every valid reply, if served
+        self.on_retire = None  # called with the index of a battery taken off the schedule
+        self.sniff = cfg.get('sniff_mode', False)
+        self.parser = (RtuParser(self.gateway.char_time, max(10 * self.gateway.silence, 0.1))
+                       if self.sniff else None)
+        self.probe_timeout = probe_timeout
+        # (HA battery index, Modbus address) of every battery that may be on this bus
+        self.batteries = [(index, protocol.battery_address(dip)) for index, dip in indexes]
+        self.active = set()  # batteries on the schedule
+        self.dormant = {}    # silent battery -> (address, Backoff)
+        self._misses = {}
+        self._reads = {}
+        self._last_addr = None
+        self._seq = 0
+        self._heap = []
+        self._demand = {}  # on-demand read key -> future shared by everyone waiting
+        self._wakeup = None
+        now = time.monotonic()
+        for index, addr in self.batteries:
+            if self.sniff:
+                continue  # nothing is polled, batteries show up with their traffic
+            if discover:
+                self.dormant[index] = (addr, Backoff(PROBE_MIN_DELAY, PROBE_MAX_DELAY, threshold=1))
+            else:
+                self.add_battery(index, addr, now)
+
+    def add_battery(self, index, addr, due):
+        self.dormant.pop(index, None)
+        self.active.add(index)
+        self._misses[index] = 0
+        for n, (interval, plan) in enumerate(self.classes):
+            self._reads[(index, n)] = build_reads(addr, plan)
+            self._push(due, index, addr, n)
+
+    def retire(self, index, addr):
+        """Take a silent battery off the schedule, it is re-probed with backoff."""
+        self.active.discard(index)
+        self._heap = [task for task in self._heap if task[2] != index]
+        heapq.heapify(self._heap)
+        backoff = Backoff(PROBE_MIN_DELAY, PROBE_MAX_DELAY, threshold=1)
+        delay = backoff.failure()
+        self.dormant[index] = (addr, backoff)
+        if self.on_retire is not None:
+            self.on_retire(index)
+        print(f"Battery {index} not answering on {self.name}, probing again in {delay:.0f}s")
+
+    def next_probe(self):
+        """(time, battery) of the dormant battery to probe first, None without any."""
+        if not self.dormant:
+            return None
+        return min((backoff.retry_at, index) for index, (_, backoff) in self.dormant.items())
+
+    def probe(self, index, addr):
+        """Blocking: one short single register read, True when the battery answered."""
+        gateway = self.gateway
+        try:
+            if not gateway.acquire():
+                return False
+            self._last_addr = addr
+            reply = gateway.request(protocol.build_read(addr, 0x0000, 1), protocol.response_len(1),
+                                    self.probe_timeout)
+        except OSError as e:
+            gateway.fail(e)
+            return False
+        return protocol.validate_response(reply, addr, 1)
+
+    def _push(self, due, index, addr, cls):
+        self._seq += 1
+        heapq.heappush(self._heap, (due, self._seq, index, addr, cls))
+
+    def poll_task(self, index, addr, cls):
+        """Blocking: run one query class against one battery, returns its buffers or None."""
+        gateway = self.gateway
+        try:
+            if not gateway.acquire():
+                return None
+            if self.next_battery_delay and self._last_addr not in (None, addr):
+                time.sleep(self.next_battery_delay)
+            self._last_addr = addr
+            return poll_battery(gateway, index, addr, self._reads[(index, cls)], self.queries_delay,
+                                self.image)
+        except OSError as e:
+            # Link dropped: the next task reconnects through acquire()
+            gateway.fail(e)
+        except Exception as e:
+            print(f"Error on {self.name}:", e)
+            gateway.close()
+        return None
+
+    def poll_range(self, index, addr, start, count):
+        """Blocking: one on-demand read outside the polled windows, True when answered."""
+        gateway = self.gateway
+        try:
+            if not gateway.acquire():
+                return False
+            if self.next_battery_delay and self._last_addr not in (None, addr):
+                time.sleep(self.next_battery_delay)
+            self._last_addr = addr
+            size = protocol.response_len(count)
+            if self.queries_delay:
+                time.sleep(self.queries_delay)
+            reply = gateway.request(protocol.build_read(addr, start, count), size)
+            if not protocol.validate_response(reply, addr, count):
+                return False
+            if self.image is not None:
+                self.image.store(index, start, reply)
+            return True
+        except OSError as e:
+            gateway.fail(e)
+        return False
+
+    async def demand_read(self, index, addr, start, count):
+        """Read registers start.. of one battery soon, sharing pending reads of the same data."""
+        end = start + count
+        covered = set()
+        keys = []
+        for cls, (_, plan) in enumerate(self.classes):
+            windows = [(s, s + c) for _, _, parts in plan for _, s, c in parts]
+            if any(s < end and start < e for s, e in windows):
+                keys.append(('class', index, addr, cls))
+                for s, e in windows:
+                    covered.update(range(max(s, start), min(e, end)))
+        if index in self.dormant or self.sniff:
+            return False
+        if len(covered) < count:
+            # Not (entirely) inside a scheduled window: read exactly what was asked
+            keys = [('range', index, addr, start, count)]
+        loop = asyncio.get_running_loop()
+        futures = []
+        for key in keys:
+            future = self._demand.get(key)
+            if future is None:
+                future = self._demand[key] = loop.create_future()
+            futures.append(future)
+        if self._wakeup:
+            self._wakeup.set()
+        return all(await asyncio.gather(*futures))
+
+    def sniff_chunk(self):
+        """Blocking: read what the bus carries, returns (index, addr, bufs) per decodable reply."""
+        gateway = self.gateway
+        try:
+            if not gateway.acquire(drain=False):
+                time.sleep(1)
+                return []
+            data = gateway.listen(1.0)
+        except OSError as e:
+            gateway.fail(e)
+            return []
+        out = []
+        indexes = {addr: index for index, addr in self.batteries}
+        for addr, start, count, reply in self.parser.feed(data, time.monotonic()):
+            if gateway.capture is not None:
+                gateway.capture.record(protocol.build_read(addr, start, count), reply, 0)
+            index = indexes.get(addr)
+            if index is None:
+                continue
+            if self.image is not None:
+                self.image.store(index, start, reply)
+            parts = covered_windows(register_map.MAP.ranges, start, count)
+            if parts:
+                out.append((index, addr, split_response(addr, start, parts, reply, count)))
+        return out
+
+    def reschedule(self, due, index, addr, cls, bufs, now):
+        """Queue the next run of a task; `bufs` is its result, None when the bus was unusable."""
+        interval = self.classes[cls][0]
+        answered = bool(bufs) and any(bufs.values())
+        if answered:
+            self._misses[index] = 0
+        elif bufs is not None:
+            self._misses[index] += 1
+            if self._misses[index] >= DEAD_AFTER:
+                self.retire(index, addr)
+                return
+        if not answered:
+            # A silent battery waits a full interval instead of queueing catch-up reads
+            next_due = now + interval
+        else:
+            # Behind schedule: run once as soon as possible, never in bursts
+            next_due = max(due + interval, now)
+        self._push(next_due, index, addr, cls)
+
+async def run_demand(bus, key, handle):
+    """Serve one on-demand read, a scheduled class read early counts as its next run."""
+    if key[0] == 'class':
+        _, index, addr, cls = key
+        bufs = await asyncio.to_thread(bus.poll_task, index, addr, cls)
+        answered = bool(bufs) and any(bufs.values())
+        now = time.monotonic()
+        bus._heap = [task for task in bus._heap if (task[2], task[4]) != (index, cls)]
+        heapq.heapify(bus._heap)
+        if index in bus.active:
+            bus.reschedule(now, index, addr, cls, bufs, now)
+        if bufs is not None:
+            handle(index, addr, bufs)
+    else:
+        answered = await asyncio.to_thread(bus.poll_range, *key[1:])
+    # Everyone who asked while the read was running shares its result
+    future = bus._demand.pop(key)
+    if not future.done():
+        future.set_result(answered)
+
+async def run_bus(bus, handle):
+    bus._wakeup = asyncio.Event()
+    while True:
+        started = time.monotonic()
+        if bus._demand:
+            await run_demand(bus, next(iter(bus._demand)), handle)
+            now = time.monotonic()
+        elif bus._heap and bus._heap[0][0] <= started:
+            due, _, index, addr, cls = heapq.heappop(bus._heap)
+            metrics.lag(bus.name, started - due)
+            bufs = await asyncio.to_thread(bus.poll_task, index, addr, cls)
+            now = time.monotonic()
+            bus.reschedule(due, index, addr, cls, bufs, now)
+            if bufs is not None:
+                handle(index, addr, bufs)
+        else:
+            probe = bus.next_probe()
+            if probe and probe[0] <= started:
+                # Idle bus: see whether a silent address came (back) to life
+                index = probe[1]
+                addr, backoff = bus.dormant[index]
+                if await asyncio.to_thread(bus.probe, index, addr):
+                    print(f"Battery {index} found on {bus.name}")
+                    bus.add_battery(index, addr, time.monotonic())
+                else:
+                    backoff.failure()
+                now = time.monotonic()
+            else:
+                wake = min(bus._heap[0][0] if bus._heap else float('inf'),
+                           probe[0] if probe else float('inf'))
+                wait = min(wake - started, 60)
+                if wait > 1:
+                    bus.gateway.release()
+                try:
+                    await asyncio.wait_for(bus._wakeup.wait(), wait)
+                except asyncio.TimeoutError:
+                    pass
+                bus._wakeup.clear()
+                continue  # the heap may have changed while sleeping
+        # Leave the bus idle long enough to stay within the configured duty cycle
+        busy = now - started
+        metrics.busy(bus.name, busy)
+        if bus.duty_cycle < 1:
+            await asyncio.sleep(busy * (1 - bus.duty_cycle) / bus.duty_cycle)
+
+async def run_sniff(bus, handle):
+    while True:
+        for index, addr, bufs in await asyncio.to_thread(bus.sniff_chunk):
+            bus.active.add(index)
+            handle(index, addr, bufs)
+
+async def run(buses, handle, *tasks):
+    """Poll (or listen to) every bus until cancelled; extra coroutines run alongside."""
+    await asyncio.gather(*(run_sniff(bus, handle) if bus.sniff else run_bus(bus, handle) for bus in buses),
+                         *tasks)
@@ -1,143 +1,68 @@
-# Battery 1 Queries
-bat_1_get_block_voltage = b'\x01\x03\x00\x00\x00\x10\x44\x06'      # Battery voltage query for Battery 1
-bat_1_not_decrypted_1 = b'\x01\x03\x00\x21\x00\x01\xd4\x00'        # Unknown at now
-bat_1_get_cells_voltage = b'\x01\x03\x00\x28\x00\x10\xc4\x0e'      # Cells voltage query for Battery 1
-bat_1_get_temperature = b'\x01\x03\x00\x78\x00\x04\xc4\x10'        # Temperature query for Battery 1
-bat_1_not_decrypted_2 = b'\x01\x03\x00\x9b\x00\x02\xb5\xe4'        # Unknown at now
-bat_1_get_extra_temperature = b'\x01\x03\x00\x91\x00\x0a\x94\x20'  # Extra temperature query for Battery 1
-bat_1_not_decrypted_3 = b'\x01\x03\x00\xef\x00\x06\xf4\x3d'        # Unknown at now
+# protocol.py
+#
+# Modbus RTU frame builder and response validator for the Ritar BMS.
+# Every query is a function 0x03 read holding registers; frames are built on
+# demand with a table driven CRC16 and cached, so any address and register
+# window can be asked for, not only the ones listed below.
 
-# Battery 2 Queries
-bat_2_get_block_voltage = b'\x02\x03\x00\x00\x00\x10\x44\x35'      # Battery voltage query for Battery 2
-bat_2_not_decrypted_1 = b'\x02\x03\x00\x21\x00\x01\xd4\x33'        # Unknown at now
-bat_2_get_cells_voltage = b'\x02\x03\x00\x28\x00\x10\xc4\x3d'      # Cells voltage query for Battery 2
-bat_2_get_temperature = b'\x02\x03\x00\x78\x00\x04\xc4\x23'        # Temperature query for Battery 2
-bat_2_not_decrypted_2 = b'\x02\x03\x00\x9b\x00\x02\xb5\xd7'        # Unknown at now
-bat_2_get_extra_temperature = b'\x02\x03\x00\x91\x00\x0a\x94\x13'  # Extra temperature query for Battery 2
-bat_2_not_decrypted_3 = b'\x02\x03\x00\xef\x00\x06\xf4\x0e'        # Unknown at now
+from functools import lru_cache
 
-# Battery 3 Queries
-bat_3_get_block_voltage = b'\x03\x03\x00\x00\x00\x10\x45\xe4'      # Battery voltage query for Battery 3
-bat_3_not_decrypted_1 = b'\x03\x03\x00\x21\x00\x01\xd5\xe2'        # Unknown at now
-bat_3_get_cells_voltage = b'\x03\x03\x00\x28\x00\x10\xc5\xec'      # Cells voltage query for Battery 3
-bat_3_get_temperature = b'\x03\x03\x00\x78\x00\x04\xc5\xf2'        # Temperature query for Battery 3
-bat_3_not_decrypted_2 = b'\x03\x03\x00\x9b\x00\x02\xb4\x06'        # Unknown at now
-bat_3_get_extra_temperature = b'\x03\x03\x00\x91\x00\x0a\x95\xc2'  # Extra temperature query for Battery 3
-bat_3_not_decrypted_3 = b'\x03\x03\x00\xef\x00\x06\xf5\xdf'        # Unknown at now
+import register_map
 
-# Battery 4 Queries
-bat_4_get_block_voltage = b'\x04\x03\x00\x00\x00\x10\x44\x53'      # Battery voltage query for Battery 4
-bat_4_not_decrypted_1 = b'\x04\x03\x00\x21\x00\x01\xd4\x55'        # Unknown at now
-bat_4_get_cells_voltage = b'\x04\x03\x00\x28\x00\x10\xc4\x5b'      # Cells voltage query for Battery 4
-bat_4_get_temperature = b'\x04\x03\x00\x78\x00\x04\xc4\x45'        # Temperature query for Battery 4
-bat_4_not_decrypted_2 = b'\x04\x03\x00\x9b\x00\x02\xb5\xb1'        # Unknown at now
-bat_4_get_extra_temperature = b'\x04\x03\x00\x91\x00\x0a\x94\x75'  # Extra temperature query for Battery 4
-bat_4_not_decrypted_3 = b'\x04\x03\x00\xef\x00\x06\xf4\x68'        # Unknown at now
+READ_HOLDING = 0x03
+MAX_ADDRESS = 247
 
-# Battery 5 Queries
-bat_5_get_block_voltage = b'\x05\x03\x00\x00\x00\x10\x45\x82'      # Battery voltage query for Battery 5
-bat_5_not_decrypted_1 = b'\x05\x03\x00\x21\x00\x01\xd5\x84'        # Unknown at now
-bat_5_get_cells_voltage = b'\x05\x03\x00\x28\x00\x10\xc5\x8a'      # Cells voltage query for Battery 5
-bat_5_get_temperature = b'\x05\x03\x00\x78\x00\x04\xc5\x94'        # Temperature query for Battery 5
-bat_5_not_decrypted_2 = b'\x05\x03\x00\x9b\x00\x02\xb4\x60'        # Unknown at now
-bat_5_get_extra_temperature = b'\x05\x03\x00\x91\x00\x0a\x95\xa4'  # Extra temperature query for Battery 5
-bat_5_not_decrypted_3 = b'\x05\x03\x00\xef\x00\x06\xf5\xb9'        # Unknown at now
+# --- CRC16 (Modbus, poly 0xA001 reflected) ---
+def _crc_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ 0xA001 if crc & 1 else crc >> 1
+        table.append(crc)
+    return tuple(table)
 
-# Battery 6 Queries
-bat_6_get_block_voltage = b'\x06\x03\x00\x00\x00\x10\x45\xb1'      # Battery voltage query for Battery 6
-bat_6_not_decrypted_1 = b'\x06\x03\x00\x21\x00\x01\xd5\xb7'        # Unknown at now
-bat_6_get_cells_voltage = b'\x06\x03\x00\x28\x00\x10\xc5\xb9'      # Cells voltage query for Battery 6
-bat_6_get_temperature = b'\x06\x03\x00\x78\x00\x04\xc5\xa7'        # Temperature query for Battery 6
-bat_6_not_decrypted_2 = b'\x06\x03\x00\x9b\x00\x02\xb4\x53'        # Unknown at now
-bat_6_get_extra_temperature = b'\x06\x03\x00\x91\x00\x0a\x95\x97'  # Extra temperature query for Battery 6
-bat_6_not_decrypted_3 = b'\x06\x03\x00\xef\x00\x06\xf5\x8a'        # Unknown at now
+CRC_TABLE = _crc_table()
 
-# Battery 7 Queries
-bat_7_get_block_voltage = b'\x07\x03\x00\x00\x00\x10\x44\x60'      # Battery voltage query for Battery 7
-bat_7_not_decrypted_1 = b'\x07\x03\x00\x21\x00\x01\xd4\x66'        # Unknown at now
-bat_7_get_cells_voltage = b'\x07\x03\x00\x28\x00\x10\xc4\x68'      # Cells voltage query for Battery 7
-bat_7_get_temperature = b'\x07\x03\x00\x78\x00\x04\xc4\x76'        # Temperature query for Battery 7
-bat_7_not_decrypted_2 = b'\x07\x03\x00\x9b\x00\x02\xb5\x82'        # Unknown at now
-bat_7_get_extra_temperature = b'\x07\x03\x00\x91\x00\x0a\x94\x46'  # Extra temperature query for Battery 7
-bat_7_not_decrypted_3 = b'\x07\x03\x00\xef\x00\x06\xf4\x5b'        # Unknown at now
+def crc16(data):
+    crc = 0xFFFF
+    table = CRC_TABLE
+    for b in data:
+        crc = (crc >> 8) ^ table[(crc ^ b) & 0xFF]
+    return crc
 
-# Battery 8 Queries
-bat_8_get_block_voltage = b'\x08\x03\x00\x00\x00\x10\x44\x9f'      # Battery voltage query for Battery 8
-bat_8_not_decrypted_1 = b'\x08\x03\x00\x21\x00\x01\xd4\x99'        # Unknown at now
-bat_8_get_cells_voltage = b'\x08\x03\x00\x28\x00\x10\xc4\x97'      # Cells voltage query for Battery 8
-bat_8_get_temperature = b'\x08\x03\x00\x78\x00\x04\xc4\x89'        # Temperature query for Battery 8
-bat_8_not_decrypted_2 = b'\x08\x03\x00\x9b\x00\x02\xb5\x7d'        # Unknown at now
-bat_8_get_extra_temperature = b'\x08\x03\x00\x91\x00\x0a\x94\xb9'  # Extra temperature query for Battery 8
-bat_8_not_decrypted_3 = b'\x08\x03\x00\xef\x00\x06\xf4\xa4'        # Unknown at now
+# --- Query frames ---
+@lru_cache(maxsize=1024)
+def build_read(addr, start, count):
+    """Function 0x03 read frame, CRC appended low byte first."""
+    if not 0 <= addr <= MAX_ADDRESS:
+        raise ValueError(f"Modbus address out of range: {addr}")
+    if not 1 <= count <= 125 or not 0 <= start <= 0xFFFF:
+        raise ValueError(f"Bad register window: start={start} count={count}")
+    body = bytes((addr, READ_HOLDING, start >> 8, start & 0xFF, count >> 8, count & 0xFF))
+    return body + crc16(body).to_bytes(2, 'little')
 
-# Battery 9 Queries
-bat_9_get_block_voltage = b'\x09\x03\x00\x00\x00\x10\x45\x4e'      # Battery voltage query for Battery 9
-bat_9_not_decrypted_1 = b'\x09\x03\x00\x21\x00\x01\xd5\x48'        # Unknown at now
-bat_9_get_cells_voltage = b'\x09\x03\x00\x28\x00\x10\xc5\x46'      # Cells voltage query for Battery 9
-bat_9_get_temperature = b'\x09\x03\x00\x78\x00\x04\xc5\x58'        # Temperature query for Battery 9
-bat_9_not_decrypted_2 = b'\x09\x03\x00\x9b\x00\x02\xb4\xac'        # Unknown at now
-bat_9_get_extra_temperature = b'\x09\x03\x00\x91\x00\x0a\x95\x68'  # Extra temperature query for Battery 9
-bat_9_not_decrypted_3 = b'\x09\x03\x00\xef\x00\x06\xf5\x75'        # Unknown at now
+def response_len(count):
+    # address + function + byte count + data + CRC
+    return 5 + 2 * count
 
-# Battery 10 Queries
-bat_10_get_block_voltage = b'\x0a\x03\x00\x00\x00\x10\x45\x7d'     # Battery voltage query for Battery 10
-bat_10_not_decrypted_1 = b'\x0a\x03\x00\x21\x00\x01\xd5\x7b'       # Unknown at now
-bat_10_get_cells_voltage = b'\x0a\x03\x00\x28\x00\x10\xc5\x75'     # Cells voltage query for Battery 10
-bat_10_get_temperature = b'\x0a\x03\x00\x78\x00\x04\xc5\x6b'       # Temperature query for Battery 10
-bat_10_not_decrypted_2 = b'\x0a\x03\x00\x9b\x00\x02\xb4\x9f'       # Unknown at now
-bat_10_get_extra_temperature = b'\x0a\x03\x00\x91\x00\x0a\x95\x5b' # Extra temperature query for Battery 10
-bat_10_not_decrypted_3 = b'\x0a\x03\x00\xef\x00\x06\xf5\x46'       # Unknown at now
+def validate_response(buf, addr, count):
+    """True when buf is a complete, uncorrupted reply to build_read(addr, _, count)."""
+    if buf is None or len(buf) != 5 + 2 * count:
+        return False
+    if buf[0] != addr or buf[1] != READ_HOLDING or buf[2] != 2 * count:
+        return False
+    return crc16(memoryview(buf)[:-2]) == buf[-2] | (buf[-1] << 8)
 
-# Battery 11 Queries
-bat_11_get_block_voltage = b'\x0b\x03\x00\x00\x00\x10\x44\xac'     # Battery voltage query for Battery 11
-bat_11_not_decrypted_1 = b'\x0b\x03\x00\x21\x00\x01\xd4\xaa'       # Unknown at now
-bat_11_get_cells_voltage = b'\x0b\x03\x00\x28\x00\x10\xc4\xa4'     # Cells voltage query for Battery 11
-bat_11_get_temperature = b'\x0b\x03\x00\x78\x00\x04\xc4\xba'       # Temperature query for Battery 11
-bat_11_not_decrypted_2 = b'\x0b\x03\x00\x9b\x00\x02\xb5\x4e'       # Unknown at now
-bat_11_get_extra_temperature = b'\x0b\x03\x00\x91\x00\x0a\x94\x8a' # Extra temperature query for Battery 11
-bat_11_not_decrypted_3 = b'\x0b\x03\x00\xef\x00\x06\xf4\x97'       # Unknown at now
+def battery_address(index):
+    # Battery 16 sits on DIP 0000, i.e. Modbus ID 0
+    return index % 16
 
-# Battery 12 Queries
-bat_12_get_block_voltage = b'\x0c\x03\x00\x00\x00\x10\x45\x1b'     # Battery voltage query for Battery 12
-bat_12_not_decrypted_1 = b'\x0c\x03\x00\x21\x00\x01\xd5\x1d'       # Unknown at now
-bat_12_get_cells_voltage = b'\x0c\x03\x00\x28\x00\x10\xc5\x13'     # Cells voltage query for Battery 12
-bat_12_get_temperature = b'\x0c\x03\x00\x78\x00\x04\xc5\x0d'       # Temperature query for Battery 12
-bat_12_not_decrypted_2 = b'\x0c\x03\x00\x9b\x00\x02\xb4\xf9'       # Unknown at now
-bat_12_get_extra_temperature = b'\x0c\x03\x00\x91\x00\x0a\x95\x3d' # Extra temperature query for Battery 12
-bat_12_not_decrypted_3 = b'\x0c\x03\x00\xef\x00\x06\xf5\x20'       # Unknown at now
+# --- Known register windows: name -> (start, count), as in register_map.yaml ---
+QUERY_WINDOWS = dict(register_map.MAP.ranges)
 
-# Battery 13 Queries
-bat_13_get_block_voltage = b'\x0d\x03\x00\x00\x00\x10\x44\xca'     # Battery voltage query for Battery 13
-bat_13_not_decrypted_1 = b'\x0d\x03\x00\x21\x00\x01\xd4\xcc'       # Unknown at now
-bat_13_get_cells_voltage = b'\x0d\x03\x00\x28\x00\x10\xc4\xc2'     # Cells voltage query for Battery 13
-bat_13_get_temperature = b'\x0d\x03\x00\x78\x00\x04\xc4\xdc'       # Temperature query for Battery 13
-bat_13_not_decrypted_2 = b'\x0d\x03\x00\x9b\x00\x02\xb5\x28'       # Unknown at now
-bat_13_get_extra_temperature = b'\x0d\x03\x00\x91\x00\x0a\x94\xec' # Extra temperature query for Battery 13
-bat_13_not_decrypted_3 = b'\x0d\x03\x00\xef\x00\x06\xf4\xf1'       # Unknown at now
-
-# Battery 14 Queries
-bat_14_get_block_voltage = b'\x0e\x03\x00\x00\x00\x10\x44\xf9'     # Battery voltage query for Battery 14
-bat_14_not_decrypted_1 = b'\x0e\x03\x00\x21\x00\x01\xd4\xff'       # Unknown at now
-bat_14_get_cells_voltage = b'\x0e\x03\x00\x28\x00\x10\xc4\xf1'     # Cells voltage query for Battery 14
-bat_14_get_temperature = b'\x0e\x03\x00\x78\x00\x04\xc4\xef'       # Temperature query for Battery 14
-bat_14_not_decrypted_2 = b'\x0e\x03\x00\x9b\x00\x02\xb5\x1b'       # Unknown at now
-bat_14_get_extra_temperature = b'\x0e\x03\x00\x91\x00\x0a\x94\xdf' # Extra temperature query for Battery 14
-bat_14_not_decrypted_3 = b'\x0e\x03\x00\xef\x00\x06\xf4\xc2'       # Unknown at now
-
-# Battery 15 Queries (last DIP 1111)
-bat_15_get_block_voltage = b'\x0f\x03\x00\x00\x00\x10\x45\x28'     # Battery voltage query for Battery 15
-bat_15_not_decrypted_1 = b'\x0f\x03\x00\x21\x00\x01\xd5\x2e'       # Unknown at now
-bat_15_get_cells_voltage = b'\x0f\x03\x00\x28\x00\x10\xc5\x20'     # Cells voltage query for Battery 15
-bat_15_get_temperature = b'\x0f\x03\x00\x78\x00\x04\xc5\x3e'       # Temperature query for Battery 15
-bat_15_not_decrypted_2 = b'\x0f\x03\x00\x9b\x00\x02\xb4\xca'       # Unknown at now
-bat_15_get_extra_temperature = b'\x0f\x03\x00\x91\x00\x0a\x95\x0e' # Extra temperature query for Battery 15
-bat_15_not_decrypted_3 = b'\x0f\x03\x00\xef\x00\x06\xf5\x13'       # Unknown at now
-
-# Battery 16 Queries (zero DIP 0000)
-bat_16_get_block_voltage = b'\x00\x03\x00\x00\x00\x10\x45\xd7'     # Battery voltage query for Battery 16
-bat_16_not_decrypted_1 = b'\x00\x03\x00\x21\x00\x01\xd5\xd1'       # Unknown at now
-bat_16_get_cells_voltage = b'\x00\x03\x00\x28\x00\x10\xc5\xdf'     # Cells voltage query for Battery 16
-bat_16_get_temperature = b'\x00\x03\x00\x78\x00\x04\xc5\xc1'       # Temperature query for Battery 16
-bat_16_not_decrypted_2 = b'\x00\x03\x00\x9b\x00\x02\xb4\x35'       # Unknown at now
-bat_16_get_extra_temperature = b'\x00\x03\x00\x91\x00\x0a\x95\xf1' # Extra temperature query for Battery 16
-bat_16_not_decrypted_3 = b'\x00\x03\x00\xef\x00\x06\xf5\xec'       # Unknown at now
+# bat_{1..16}_get_<window> names as used by the reverse engineering notes
+for _index in range(1, 17):
+    for _name, (_start, _count) in QUERY_WINDOWS.items():
+        globals()[f'bat_{_index}_get_{_name}'] = build_read(battery_address(_index), _start, _count)
+del _index, _name, _start, _count
@@ -0,0 +1,70 @@
+# read_planner.py
+
+import time
+import protocol
+
+# Modbus limit for a single function 0x03 read
+MAX_READ_REGS = 125
+
+def plan_reads(windows, max_gap=0, max_span=16):
+    """Merge register windows into as few reads as max_gap / max_span allow.
+
+    Returns a list of (start, count, parts), parts being (name, start, count).
+    A window bigger than max_span on its own is still read as one piece.
+    """
+    max_span = min(max_span, MAX_READ_REGS)
+    plan = []
+    for name, (start, count) in sorted(windows.items(), key=lambda kv: kv[1]):
+        end = start + count
+        if plan:
+            p_start, p_end, parts = plan[-1]
+            if start - p_end <= max_gap and max(end, p_end) - p_start <= max_span:
+                parts.append((name, start, count))
+                plan[-1] = (p_start, max(end, p_end), parts)
+                continue
+        plan.append((start, end, [(name, start, count)]))
+    return [(start, end - start, parts) for start, end, parts in plan]
+
+def build_reads(addr, plan):
+    """Precompute (frame, response length, start, parts) for one Modbus address."""
+    return [(protocol.build_read(addr, start, count), protocol.response_len(count), start, parts)
+            for start, count, parts in plan]
+
+def split_response(addr, start, parts, buf, count=None):
+    """Validate a reply and cut it back into the per-window frames the decoders expect.
+
+    Corrupt, short or foreign replies give None for every window they covered.
+    `count` is the size of the read when it reaches beyond its last window.
+    """
+    if count is None:
+        count = max(s + c for _, s, c in parts) - start
+    if not protocol.validate_response(buf, addr, count):
+        return {name: None for name, _, _ in parts}
+    if len(parts) == 1 and parts[0][1] == start and parts[0][2] == count:
+        # Nothing merged - hand the reply through untouched
+        return {parts[0][0]: buf}
+    out = {}
+    for name, s, c in parts:
+        off = 3 + 2 * (s - start)
+        body = bytes((addr, protocol.READ_HOLDING, 2 * c)) + buf[off:off + 2 * c]
+        out[name] = body + protocol.crc16(body).to_bytes(2, 'little')
+    return out
+
+def probe_max_span(gateway, addr, start=0x0000, known_good=16, delay=0):
+    """Binary search the largest register count the BMS answers in one read."""
+    lo, hi = known_good, MAX_READ_REGS
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if delay:
+            time.sleep(delay)
+        try:
+            reply = gateway.request(protocol.build_read(addr, start, mid), protocol.response_len(mid))
+            ok = protocol.validate_response(reply, addr, mid)
+        except OSError:
+            ok = False
+        print(f"Probe span {mid} regs: {'ok' if ok else 'rejected'}")
+        if ok:
+            lo = mid
+        else:
+            hi = mid - 1
+    return lo
@@ -0,0 +1,204 @@
+# register_map.py
+#
+# Loads register_map.yaml and compiles every window into a decoder: one
+# precompiled Struct over the window's registers (unused ones skipped) and a
+# generated function with offsets, scales, biases, rounding and limits
+# inlined. Decoding a reply is a single unpack_from and straight line code.
+
+import os
+import struct
+import sys
+import yaml
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'register_map.yaml')
+
+TYPES = {'uint16': 'H', 'int16': 'h'}
+INF = float('inf')
+
+def _literal(limit):
+    # repr() of an infinite limit is not valid source
+    return limit if abs(limit) != INF else ('INF' if limit > 0 else '-INF')
+
+class Field:
+    __slots__ = ('name', 'label', 'window', 'register', 'type', 'offset', 'scale', 'bias', 'round',
+                 'unit', 'device_class', 'state_class', 'entity_category', 'min', 'max', 'spike')
+
+    def __init__(self, window, spec, n, register):
+        fmt = {'n': n, 'r': register}
+        self.name = str(spec['name']).format(**fmt)
+        self.label = str(spec.get('label', spec['name'])).format(**fmt)
+        self.window = window
+        self.register = register
+        self.type = spec.get('type', 'uint16')
+        if self.type not in TYPES:
+            raise ValueError(f"{self.name}: type must be {' or '.join(TYPES)}")
+        self.offset = spec.get('offset', 0)
+        self.scale = spec.get('scale', 1)
+        self.bias = spec.get('bias', 0)
+        self.round = spec.get('round')
+        self.unit = spec.get('unit')
+        self.device_class = spec.get('device_class')
+        self.state_class = spec.get('state_class')
+        self.entity_category = spec.get('entity_category')
+        self.min = spec.get('min', -INF)
+        self.max = spec.get('max', INF)
+        self.spike = spec.get('spike')
+
+class Window:
+    def __init__(self, name, spec):
+        self.name = name
+        self.start = int(spec['start'])
+        self.count = int(spec['count'])
+        self.interval = spec.get('interval', 'read_timeout')
+        self.poll = spec.get('poll', True)
+        self.only_after = spec.get('only_after')
+        self.min_valid = spec.get('min_valid', 0)
+        self.frame_len = 5 + 2 * self.count
+        self.fields = []
+        for fspec in spec.get('fields', []):
+            first = int(fspec.get('register', 0))
+            for n in range(int(fspec.get('repeat', 1))):
+                register = first + n
+                if not 0 <= register < self.count:
+                    raise ValueError(f"{name}: register {register} outside the window")
+                self.fields.append(Field(name, fspec, n + 1, self.start + register))
+        self.fields.sort(key=lambda f: f.register)
+        self.required = [f for f in self.fields if f.name in spec.get('required', ())]
+        if len(self.required) != len(spec.get('required', ())):
+            raise ValueError(f"{name}: required names a field the window does not have")
+        # One Struct over the whole window, registers without a field are skipped
+        used = {f.register - self.start: TYPES[f.type] for f in self.fields}
+        if len(used) != len(self.fields):
+            raise ValueError(f"{name}: two fields share a register")
+        self.struct = struct.Struct('>' + ''.join(used.get(r, '2x') for r in range(self.count)))
+        self.decode = self._compile()
+
+    def _compile(self):
+        """Generate the window's decode function, every constant inlined.
+
+        decode(frame) gives name -> value (None outside the limits); None when
+        the frame has the wrong size, {} when a required field is out of
+        limits or fewer than min_valid fields are within them.
+        """
+        names = [f'v{i}' for i in range(len(self.fields))]
+        lines = ['def decode(frame):',
+                 f'    if frame is None or len(frame) != {self.frame_len}:',
+                 '        return None',
+                 f"    {''.join(n + ', ' for n in names)}= unpack_from(frame, 3)"]
+        for v, f in zip(names, self.fields):
+            expr = v
+            if f.offset:
+                expr = f'({expr} + {f.offset!r})'
+            if f.scale != 1:
+                expr = f'{expr} * {f.scale!r}'
+            if f.bias:
+                expr = f'{expr} + {f.bias!r}'
+            if f.round is not None:
+                expr = f'round({expr}, {f.round!r})'
+            if expr != v:
+                lines.append(f'    {v} = {expr}')
+            if f.min != -INF or f.max != INF:
+                lines.append(f'    if not {_literal(f.min)} <= {v} <= {_literal(f.max)}:')
+                lines.append(f'        {v} = None')
+        for f in self.required:
+            if f.min == -INF and f.max == INF:
+                continue
+            lines.append(f'    if {names[self.fields.index(f)]} is None:')
+            lines.append('        return {}')
+        if self.min_valid:
+            lines.append(f"    if ({', '.join(names)},).count(None) > {len(names) - self.min_valid}:")
+            lines.append('        return {}')
+        lines.append('    return {' + ', '.join(f'{f.name!r}: {v}' for v, f in zip(names, self.fields)) + '}')
+        self.source = '\n'.join(lines)
+        namespace = {'unpack_from': self.struct.unpack_from, 'INF': INF}
+        exec(self.source, namespace)
+        return namespace['decode']
+
+class Derived:
+    def __init__(self, spec):
+        self.name = spec['name']
+        self.label = spec.get('label', self.name)
+        self.product = tuple(spec['product'])
+        self.round = spec.get('round')
+        self.unit = spec.get('unit')
+        self.device_class = spec.get('device_class')
+        self.state_class = spec.get('state_class')
+        self.entity_category = spec.get('entity_category')
+        self.min, self.max, self.spike = -INF, INF, None
+
+    def compute(self, values):
+        result = 1
+        for name in self.product:
+            v = values.get(name)
+            if v is None:
+                return None
+            result *= v
+        return round(result, self.round)
+
+class RegisterMap:
+    def __init__(self, doc):
+        self.windows = {name: Window(name, spec) for name, spec in doc['windows'].items()}
+        self.derived = [Derived(spec) for spec in doc.get('derived', [])]
+        self.fields = {}
+        for window in self.windows.values():
+            for field in window.fields:
+                if field.name in self.fields:
+                    raise ValueError(f"field {field.name} defined twice")
+                self.fields[field.name] = field
+        for d in self.derived:
+            if not set(d.product) <= set(self.fields):
+                raise ValueError(f"{d.name}: product of unknown fields")
+            self.fields[d.name] = d
+        for window in self.windows.values():
+            if window.only_after is not None and window.only_after not in self.windows:
+                raise ValueError(f"{window.name}: only_after names no window")
+        # Every window and the polled ones: name -> (start, count), plus interval option -> window names
+        self.ranges = {n: (w.start, w.count) for n, w in self.windows.items()}
+        self.polled = {n: r for n, r in self.ranges.items() if self.windows[n].poll}
+        self.classes = {}
+        for name, window in self.windows.items():
+            if window.poll:
+                self.classes.setdefault(window.interval, []).append(name)
+
+    def decode(self, bufs):
+        """Decode {window name: frame} into name -> value, derived values included.
+
+        Returns (values, rejected): rejected names the windows whose frame was
+        fine but failed a plausibility rule.
+        """
+        values = {}
+        rejected = []
+        for name, frame in bufs.items():
+            window = self.windows.get(name)
+            if window is None:
+                continue
+            decoded = window.decode(frame)
+            if decoded == {}:
+                rejected.append(name)
+            elif decoded:
+                values.update(decoded)
+        for d in self.derived:
+            if all(name in values for name in d.product):
+                values[d.name] = d.compute(values)
+        return values, rejected
+
+    def history_fields(self):
+        """Numeric fields of the polled windows plus derived ones, in map order."""
+        return [f.name for w in self.windows.values() if w.poll for f in w.fields] + [d.name for d in self.derived]
+
+def load(path=None):
+    """Compile a register map file, exits with a readable error when it is unusable."""
+    path = path or DEFAULT_PATH
+    try:
+        with open(path) as f:
+            return RegisterMap(yaml.safe_load(f))
+    except (OSError, KeyError, TypeError, ValueError, yaml.YAMLError) as e:
+        sys.exit(f"Error: register map {path}: {e}")
+
+def use(path):
+    """Replace the active map, modules read register_map.MAP at call time."""
+    global MAP
+    MAP = load(path)
+    return MAP
+
+MAP = load()
@@ -1,32 +1,50 @@
 #!/usr/bin/env python3
 
 import time
-import binascii
+import asyncio
+import atexit
 import os
+import signal
 import sys
 import yaml
 import json
 import warnings
 import paho.mqtt.client as mqtt
-import protocol
-from modbus_gateway import ModbusGateway
+import poll_engine
+import history
+import capture
+import mqtt_queue
+import stack as stack_aggregates
+import register_map
+from modbus_server import RegisterImage, serve_modbus
+from read_planner import plan_reads, probe_max_span
+from metrics import metrics, serve_prometheus, ERRORS
 
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
-# --- Static limits ---
-cell_min_limit = 2450
-cell_max_limit = 4750
-volt_min_limit = 40.00
-volt_max_limit = 60.00
-temp_min_limit = -20
-temp_max_limit = 55
+# Register map in use, replaced by the register_map option
+regmap = register_map.MAP
 
-# Store last valid cycle counts
-last_valid_cycle_count = {}
+# Last value within the spike limit, per (battery, field)
+last_good = {}
 
-# Store last valid temperatures
-last_valid_temps = {}
-last_valid_extra = {}
+# Discovery configs already sent this MQTT session
+discovery_sent = set()
+
+# Last published state per topic: (value, monotonic time)
+last_published = {}
+
+# Smallest change worth a state publish, by unit
+STATE_DEADBAND = {'V': 0.01, '%': 0.1, 'A': 0.01, 'W': 1, 'mV': 1, '°C': 0.1, 'kWh': 0.01, 'Ah': 0.1}
+
+# Republish unchanged states at least this often (seconds)
+state_heartbeat = 300
+
+# Publish one JSON document per battery instead of one topic per sensor
+json_state = False
+json_documents = {}
+
+publish_stats = {'config_sent': 0, 'config_suppressed': 0, 'state_sent': 0, 'state_suppressed': 0}
 
 # --- Configuration loader ---
 def load_config():
@@ -39,7 +57,7 @@ def load_config():
             cfg = y.get('options', {})
     else:
         sys.exit("Error: No config file found")
-    if cfg.get('connection_type') not in ('ethernet', 'serial'):
+    if not cfg.get('gateways') and cfg.get('connection_type') not in ('ethernet', 'serial'):
         sys.exit("Error: connection_type must be 'ethernet' or 'serial'")
     return cfg
 
@@ -53,88 +71,110 @@ def to_float(value, name):
         sys.exit(f"Error: {name} must be a number, got {value}")
 
 def validate_delay(cfg):
-    qd = to_float(cfg.get('queries_delay', '0.1'), 'queries_delay')
-    nb = to_float(cfg.get('next_battery_delay', '0.5'), 'next_battery_delay')
+    qd = to_float(cfg.get('queries_delay', '0'), 'queries_delay')
+    nb = to_float(cfg.get('next_battery_delay', '0'), 'next_battery_delay')
     return qd, nb
 
-def valid_len(buf, length):
-    return buf is not None and len(buf) == length
-
-def hex_to_temperature(hex_str):
-    pairs = [hex_str[i:i+2] for i in range(0, len(hex_str), 2)]
-    data = pairs[3:-2]
-    if len(data) % 2:
-        data = data[:-1]
-    temps = []
-    for i in range(0, len(data), 2):
-        raw = int(data[i] + data[i+1], 16)
-        temps.append(round((raw - 726) * 0.1 + 22.6, 1))
-    return temps
-
-def process_extra_temperature(data):
-    if not valid_len(data, 25):
-        return None, None
-    hx = binascii.hexlify(data).decode()
-    mos_raw = int(hx[6:10], 16)
-    env_raw = int(hx[10:14], 16)
-    mos = round((mos_raw - 726) * 0.1 + 22.6, 1)
-    env = round((env_raw - 726) * 0.1 + 22.6, 1)
-    mos_valid = mos if temp_min_limit <= mos <= temp_max_limit else None
-    env_valid = env if temp_min_limit <= env <= temp_max_limit else None
-    return mos_valid, env_valid
-
-def filter_temperature_spikes(new_vals, last_vals, delta_limit=10):
-    """Filter temperature list values based on max delta compared to last good values."""
-    filtered = []
-    for i, val in enumerate(new_vals):
-        if val is None or not (temp_min_limit <= val <= temp_max_limit):
-            filtered.append(None)
-        elif i < len(last_vals):
-            if abs(val - last_vals[i]) > delta_limit:
-                filtered.append(last_vals[i])  # reuse last known good value
-            else:
-                filtered.append(val)
-        else:
-            filtered.append(val)
-    return filtered
-
-def process_battery_data(index, block_buf, cells_buf, temp_buf):
-    result = {
-        'voltage': None,
-        'soc': None,
-        'cycle': None,
-        'current': None,
-        'power': None,
-        'cells': None,
-        'temps': None
+def load_query_classes(cfg, gap, span):
+    """(interval, read plan) per polling rate; windows sharing a rate are planned together."""
+    default = cfg.get('read_timeout', 15)
+    by_interval = {}
+    for key, names in regmap.classes.items():
+        interval = to_float(cfg.get(key, default), key)
+        if interval <= 0:
+            sys.exit(f"Error: {key} must be above 0")
+        by_interval.setdefault(interval, {}).update({n: regmap.polled[n] for n in names})
+    return [(interval, plan_reads(windows, gap, span)) for interval, windows in sorted(by_interval.items())]
+
+def validate_read_plan(cfg):
+    gap = int(cfg.get('read_max_gap', 0))
+    span = int(cfg.get('read_max_span', 16))
+    if gap < 0 or not 1 <= span <= 125:
+        sys.exit("Error: read_max_gap must be >= 0 and read_max_span within 1..125")
+    return gap, span
+
+def load_buses(cfg):
+    """One entry per RS485 bus: (name, gateway config, [(HA index, DIP index)]).
+
+    Without a `gateways` list the top level connection settings describe a
+    single bus with batteries 1..num_batteries. With auto_discover every bus
+    may hold batteries 1..16 unless its range is given.
+    """
+    gateways = cfg.get('gateways') or [{}]
+    buses = []
+    seen = set()
+    for n, gw in enumerate(gateways, start=1):
+        gw_cfg = dict(cfg, **gw)
+        if gw_cfg.get('connection_type') not in ('ethernet', 'serial'):
+            sys.exit(f"Error: gateway {n} connection_type must be 'ethernet' or 'serial'")
+        first = int(gw.get('first_battery', 1))
+        last = int(gw.get('last_battery', 16 if cfg.get('auto_discover') else cfg.get('num_batteries', 1)))
+        offset = int(gw.get('index_offset', 0))
+        if not 1 <= first <= last <= 16:
+            sys.exit(f"Error: gateway {n} battery range must be within 1..16, got {first}..{last}")
+        indexes = [(offset + i, i) for i in range(first, last + 1)]
+        clash = seen.intersection(index for index, _ in indexes)
+        if clash:
+            sys.exit(f"Error: battery numbers {sorted(clash)} used by more than one gateway, set index_offset")
+        seen.update(index for index, _ in indexes)
+        buses.append((f"gateway {n}", gw_cfg, indexes))
+    return buses
+
+def reset_discovery():
+    """Forget what was sent, so configs and states go out again (reconnect, HA restart)."""
+    discovery_sent.clear()
+    last_published.clear()
+
+def state_changed(topic, value, deadband, now):
+    last = last_published.get(topic)
+    if last is None or now - last[1] >= state_heartbeat:
+        return True
+    old = last[0]
+    if value is None or old is None:
+        return value is not old
+    return abs(value - old) >= deadband - 1e-9 and value != old
+
+def mqtt_publish(publisher, topic, payload, kind='state'):
+    # Only queued here, the publisher's worker thread talks to the broker
+    publisher.put(topic, payload, kind)
+
+def send_discovery(publisher, index, base, device_info, suffix, name, dev_class, unit, state_class,
+                   state_topic, value_template, extra=None):
+    cfg_topic = f"{base}/{suffix}/config"
+    if cfg_topic in discovery_sent:
+        publish_stats['config_suppressed'] += 1
+        return
+    cfg = {
+        'name': name,
+        'state_topic': state_topic,
+        'unique_id': f"ritar_{index}_{suffix}",
+        'object_id': f"ritar_{index}_{suffix}",
+        'device_class': dev_class,
+        'unit_of_measurement': unit,
+        'value_template': value_template,
+        'device': device_info
     }
-    # Block voltage
-    if valid_len(block_buf, 37):
-        hb = binascii.hexlify(block_buf).decode()
-        cur_raw = int(hb[6:10], 16)
-        if cur_raw >= 0x8000:
-            cur_raw -= 0x10000
-        current = round(cur_raw / 100, 2)
-        voltage = round(int(hb[10:14], 16) / 100, 2)
-        soc = round(int(hb[14:18], 16) / 10, 1)
-        cycle = int(hb[34:38], 16)
-        power = round(current * voltage, 2)
-        result.update({'current': current, 'voltage': voltage, 'soc': soc, 'cycle': cycle, 'power': power})
-    # Cells voltage
-    if valid_len(cells_buf, 37) and cells_buf[0] == index:
-        hv = binascii.hexlify(cells_buf).decode()
-        raw_cells = [int(hv[6 + 4*i:10 + 4*i], 16) for i in range(16)]
-        filtered = [v if cell_min_limit <= v <= cell_max_limit else None for v in raw_cells]
-        if len([v for v in filtered if v is not None]) >= 8:
-            result['cells'] = filtered
-    # Temperature buffer
-    if valid_len(temp_buf, 13):
-        hx = binascii.hexlify(temp_buf).decode()
-        temps = hex_to_temperature(hx)
-        result['temps'] = [t for t in temps if temp_min_limit <= t <= temp_max_limit]
-    return result
-
-def publish_sensors(client, index, data, mos_temp, env_temp, model):
+    if state_class:
+        cfg['state_class'] = state_class
+    if extra:
+        cfg.update(extra)
+    mqtt_publish(publisher, cfg_topic, json.dumps(cfg), 'config')
+    discovery_sent.add(cfg_topic)
+    publish_stats['config_sent'] += 1
+
+def filter_spikes(index, values):
+    """Hold the last good value of fields that jumped further than their spike limit."""
+    for name, value in values.items():
+        spike = regmap.fields[name].spike
+        if spike is None or value is None:
+            continue
+        last = last_good.get((index, name))
+        if last is not None and abs(value - last) > spike:
+            values[name] = last
+        else:
+            last_good[(index, name)] = value
+
+def publish_sensors(publisher, index, values, model):
     base = f"homeassistant/sensor/ritar_{index}"
     device_info = {
         'identifiers': [f"ritar_{index}"],
@@ -142,65 +182,144 @@ def publish_sensors(client, index, data, mos_temp, env_temp, model):
         'model': model,
         'manufacturer': 'Ritar'
     }
-    def pub(suffix, name, dev_class, unit, value, state_class=None):
-        cfg_topic = f"{base}/{suffix}/config"
+    # Entities follow the register map: (suffix, name, device class, unit, value, state class, extra)
+    sensors = []
+    for name, value in values.items():
+        field = regmap.fields[name]
+        extra = {'entity_category': field.entity_category} if field.entity_category else None
+        sensors.append((name, field.label, field.device_class, field.unit, value, field.state_class, extra))
+
+    now = time.monotonic()
+    if json_state:
+        publish_document(publisher, index, base, device_info, sensors, now)
+        return sensors
+    for suffix, name, dev_class, unit, value, state_class, extra in sensors:
         state_topic = f"{base}/{suffix}"
-        cfg = {
-            'name': name,
-            'state_topic': state_topic,
-            'unique_id': f"ritar_{index}_{suffix}",
-            'object_id': f"ritar_{index}_{suffix}",
-            'device_class': dev_class,
-            'unit_of_measurement': unit,
-            'value_template': '{{ value_json.state }}',
-            'device': device_info
+        send_discovery(publisher, index, base, device_info, suffix, name, dev_class, unit, state_class,
+                       state_topic, '{{ value_json.state }}', extra)
+        if state_changed(state_topic, value, STATE_DEADBAND.get(unit, 0), now):
+            mqtt_publish(publisher, state_topic, json.dumps({'state': value}))
+            last_published[state_topic] = (value, now)
+            publish_stats['state_sent'] += 1
+        else:
+            publish_stats['state_suppressed'] += 1
+    return sensors
+
+def publish_document(publisher, index, base, device_info, sensors, now):
+    """Single JSON state per battery, every sensor reads its field via value_template."""
+    state_topic = f"{base}/state"
+    doc = json_documents.setdefault(index, {})
+    changed = False
+    for suffix, name, dev_class, unit, value, state_class, extra in sensors:
+        send_discovery(publisher, index, base, device_info, suffix, name, dev_class, unit, state_class,
+                       state_topic, f"{{{{ value_json.{suffix} }}}}", extra)
+        key = f"{state_topic}/{suffix}"
+        if state_changed(key, value, STATE_DEADBAND.get(unit, 0), now):
+            changed = True
+        doc[suffix] = value
+    if not changed:
+        publish_stats['state_suppressed'] += 1
+        return
+    # Fields missing this cycle keep their last value, like retained per-sensor topics do
+    mqtt_publish(publisher, state_topic, json.dumps(doc, separators=(',', ':')))
+    for suffix, value in doc.items():
+        last_published[f"{state_topic}/{suffix}"] = (value, now)
+    publish_stats['state_sent'] += 1
+
+def publish_aggregates(publisher, index, values, stack, model):
+    """Per battery aggregates on the battery's device, the stack totals on a ritar_stack device."""
+    now = time.monotonic()
+    def pub(device, device_info, sensors, values):
+        base = f"homeassistant/sensor/ritar_{device}"
+        for suffix, value in values.items():
+            name, dev_class, unit, state_class = sensors[suffix]
+            state_topic = f"{base}/{suffix}"
+            send_discovery(publisher, device, base, device_info, suffix, name, dev_class, unit, state_class,
+                           state_topic, '{{ value_json.state }}')
+            if state_changed(state_topic, value, STATE_DEADBAND.get(unit, 0), now):
+                mqtt_publish(publisher, state_topic, json.dumps({'state': value}))
+                last_published[state_topic] = (value, now)
+                publish_stats['state_sent'] += 1
+            else:
+                publish_stats['state_suppressed'] += 1
+    if values:
+        device_info = {
+            'identifiers': [f"ritar_{index}"],
+            'name': f"Ritar Battery {index}",
+            'model': model,
+            'manufacturer': 'Ritar'
         }
-        if state_class:
-            cfg['state_class'] = state_class
-        client.publish(cfg_topic, json.dumps(cfg), retain=True)
-        client.publish(state_topic, json.dumps({'state': value}), retain=True)
-    # Core sensors
-    pub('voltage', 'Voltage', 'voltage', 'V', data['voltage'])
-    pub('soc', 'SOC', 'battery', '%', data['soc'])
-    pub('current', 'Current', 'current', 'A', data['current'])
-    pub('power', 'Power', 'power', 'W', data['power'])
-    # Cycle count
-    cycle = data['cycle']
-    if isinstance(cycle, int):
-        last_valid_cycle_count[index] = cycle
-        pub('cycle', 'Cycle Count', None, None, cycle, state_class='total_increasing')
-    elif index in last_valid_cycle_count:
-        pub('cycle', 'Cycle Count', None, None, last_valid_cycle_count[index], state_class='total_increasing')
-    # Cell voltages
-    if data['cells']:
-        for i, v in enumerate(data['cells'], start=1):
-            pub(f'cell_{i:02d}', f'Cell {i:02d}', 'voltage', 'mV', v)
-    # Temperatures
-    if data['temps']:
-        last_temps = last_valid_temps.get(index, [])
-        valid_temps = filter_temperature_spikes(data['temps'], last_temps)
-        last_valid_temps[index] = valid_temps
-        for i, t in enumerate(valid_temps, start=1):
-            pub(f'temp_{i}', f'Temp {i}', 'temperature', '°C', t)
-    # Extra temperatures
-    last_mos, last_env = last_valid_extra.get(index, (None, None))
-    def within_delta(new, old, limit=10):
-        return old is None or abs(new - old) <= limit
-    if mos_temp is not None and within_delta(mos_temp, last_mos):
-        last_mos = mos_temp
-        pub('temp_mos', 'T MOS', 'temperature', '°C', mos_temp)
-    if env_temp is not None and within_delta(env_temp, last_env):
-        last_env = env_temp
-        pub('temp_env', 'T ENV', 'temperature', '°C', env_temp)
-    last_valid_extra[index] = (last_mos, last_env)
+        pub(index, device_info, stack_aggregates.BATTERY_SENSORS, values)
+    device_info = {
+        'identifiers': ['ritar_stack'],
+        'name': 'Ritar Stack',
+        'model': model,
+        'manufacturer': 'Ritar'
+    }
+    pub('stack', device_info, stack_aggregates.STACK_SENSORS, stack.summary())
+
+def publish_diagnostics(publisher, indexes, buses, model):
+    """Per battery error/latency counters and add-on wide timings as HA diagnostic entities."""
+    diag = {'entity_category': 'diagnostic'}
+    def pub(index, device_info, suffix, name, unit, value, state_class='measurement'):
+        base = f"homeassistant/sensor/ritar_{index}"
+        state_topic = f"{base}/{suffix}"
+        send_discovery(publisher, index, base, device_info, suffix, name, None, unit, state_class,
+                       state_topic, '{{ value_json.state }}', diag)
+        mqtt_publish(publisher, state_topic, json.dumps({'state': value}), 'diagnostic')
+    for index in indexes:
+        device_info = {
+            'identifiers': [f"ritar_{index}"],
+            'name': f"Ritar Battery {index}",
+            'model': model,
+            'manufacturer': 'Ritar'
+        }
+        summary = metrics.battery_summary(index)
+        pub(index, device_info, 'diag_latency', 'Query Latency', 'ms', summary['latency'])
+        for kind in ERRORS:
+            pub(index, device_info, f'diag_{kind}', kind.replace('_', ' ').title(), None, summary[kind],
+                state_class='total_increasing')
+    device_info = {
+        'identifiers': ['ritar_bms'],
+        'name': 'Ritar BMS Add-on',
+        'manufacturer': 'Ritar'
+    }
+    for n, bus in enumerate(buses, start=1):
+        lag = metrics.bus_lag.get(bus.name)
+        pub('bms', device_info, f'bus_lag_{n}', f'Scheduling Lag {bus.name.title()}', 'ms',
+            round(lag * 1000, 1) if lag is not None else None)
+        busy = metrics.utilisation(bus.name)
+        pub('bms', device_info, f'bus_utilisation_{n}', f'Bus Utilisation {bus.name.title()}', '%',
+            round(busy * 100, 1) if busy is not None else None)
+    for stage in ('decode', 'publish'):
+        hist = metrics.stages.get(stage)
+        mean = hist.mean if hist else None
+        pub('bms', device_info, f'{stage}_time', f'{stage.title()} Time', 'ms',
+            round(mean * 1000, 3) if mean is not None else None)
+    pub('bms', device_info, 'mqtt_backlog', 'MQTT Backlog', None, publisher.backlog())
+    pub('bms', device_info, 'mqtt_coalesced', 'MQTT Superseded', None, publisher.coalesced, 'total_increasing')
+    pub('bms', device_info, 'mqtt_dropped', 'MQTT Dropped', None, publisher.dropped, 'total_increasing')
 
 # --- Main execution ---
 if __name__ == '__main__':
     config = load_config()
-    gateway = ModbusGateway(config)
+    if config.get('register_map'):
+        regmap = register_map.use(config['register_map'])
     battery_model = config.get('battery_model', 'BAT-5KWH-51.2V')
     read_timeout = config.get('read_timeout', 15)
     queries_delay, next_battery_delay = validate_delay(config)
+    read_max_gap, read_max_span = validate_read_plan(config)
+    classes = load_query_classes(config, read_max_gap, read_max_span)
+    duty_cycle = to_float(config.get('bus_duty_cycle', 1), 'bus_duty_cycle')
+    if not 0 < duty_cycle <= 1:
+        sys.exit("Error: bus_duty_cycle must be within 0..1")
+    auto_discover = config.get('auto_discover', False)
+    discover_timeout = to_float(config.get('discover_timeout', 0.5), 'discover_timeout')
+    buses = [
+        poll_engine.Bus(name, cfg, indexes, classes, queries_delay, next_battery_delay, duty_cycle,
+                        auto_discover, discover_timeout)
+        for name, cfg, indexes in load_buses(config)
+    ]
 
     # MQTT setup
     client = mqtt.Client(client_id='ritar_bms', protocol=mqtt.MQTTv311)
@@ -208,95 +327,254 @@ if __name__ == '__main__':
         config.get('mqtt_username', 'homeassistant'),
         config.get('mqtt_password', 'mqtt_password_here')
     )
-    client.connect(
+    # Connected and reconnected in paho's own thread, polling never waits for the broker
+    client.reconnect_delay_set(1, 60)
+    client.connect_async(
         config.get('mqtt_broker', 'core-mosquitto'),
         config.get('mqtt_port', 1883),
         60
     )
-    client.on_disconnect = lambda c, u, rc: c.reconnect()
+    queue_size = int(config.get('mqtt_queue_size', 4096))
+    if queue_size < 1:
+        sys.exit("Error: mqtt_queue_size must be at least 1")
+    publisher = mqtt_queue.PublishQueue(client, queue_size)
+    publisher.on_drop = discovery_sent.discard  # a dropped config is sent again with the next state
+    state_heartbeat = config.get('state_heartbeat', 300)
+    json_state = config.get('json_state', False)
+
+    # Optional on-disk history, queried over MQTT
+    history_store = None
+    history_requests = []
+    if config.get('history', False):
+        raw_hours = to_float(config.get('history_raw_hours', 6), 'history_raw_hours')
+        if raw_hours <= 0:
+            sys.exit("Error: history_raw_hours must be positive")
+        fastest = min(interval for interval, _ in classes)
+        history_dir = '/data/history' if os.path.isdir('/data') else 'history'
+        history_store = history.HistoryStore(history_dir, max(1, int(raw_hours * 3600 / fastest)),
+                                             regmap.history_fields())
+
+    # Optional stack wide aggregates and energy counters
+    stack = None
+    # Not while replaying: old samples would count energy again on the live stack device
+    if config.get('stack_aggregates', False) and not config.get('replay_capture'):
+        windows = regmap.windows
+        cell_fields = [f.name for f in windows['cells_voltage'].fields] if 'cells_voltage' in windows else []
+        temp_fields = [f.name for f in windows['temperature'].fields] if 'temperature' in windows else []
+        # Power and current arrive with their window's rate, a longer silence is not integrated over
+        source = regmap.fields['current'].window if 'current' in regmap.fields else None
+        rate = next((interval for interval, plan in classes for _, _, parts in plan
+                     if any(name == source for name, _, _ in parts)), read_timeout)
+        stack_path = '/data/stack.json' if os.path.isdir('/data') else 'stack.json'
+        stack = stack_aggregates.Stack(cell_fields, temp_fields, stack_path, max(30, 3 * rate))
+        atexit.register(stack.save)
+        for bus in buses:
+            bus.on_retire = stack.remove
+
+    # Resend discovery after a reconnect or when Home Assistant comes back online
+    def on_connect(c, *args):
+        if not c.is_connected():
+            return  # refused, paho retries
+        reset_discovery()
+        c.subscribe('homeassistant/status')
+        if history_store:
+            c.subscribe(history.REQUEST_TOPIC)
+        publisher.on_connect()
+    def on_message(c, userdata, msg):
+        if msg.topic == 'homeassistant/status' and msg.payload == b'online':
+            reset_discovery()
+        elif msg.topic == history.REQUEST_TOPIC:
+            # Answered on the event loop thread, which owns the history files
+            history_requests.append(msg.payload)
+    client.on_connect = on_connect
+    client.on_message = on_message
+    client.on_publish = lambda c, u, mid, *args: publisher.on_publish(mid)
+    client.on_disconnect = lambda c, *args: publisher.on_disconnect()
     client.loop_start()
 
     # Print configuration
-    print(f"Connection Type: {gateway.type.title()}")
-    if gateway.type == 'ethernet':
-        print(f"  IP   : {config['rs485gate_ip']}")
-        print(f"  Port : {config['rs485gate_port']}")
-    else:
-        print(f"  Device: {config['serial_port']}")
-        print(f"  Baud  : {config.get('serial_baudrate', 9600)}")
+    for n, bus in enumerate(buses, start=1):
+        gateway = bus.gateway
+        print(f"Connection Type: {gateway.type.title()} ({bus.name})")
+        if gateway.type == 'ethernet':
+            print(f"  IP   : {bus.cfg['rs485gate_ip']}")
+            print(f"  Port : {bus.cfg['rs485gate_port']}")
+        else:
+            print(f"  Device: {bus.cfg['serial_port']}")
+            print(f"  Baud  : {bus.cfg.get('serial_baudrate', 9600)}")
+        print(f"  {'Scan For' if auto_discover else 'Batteries'}: {', '.join(str(index) for index, _ in bus.batteries)}")
+        print(f"  Persistent Conn.: {gateway.persistent}")
+        if bus.sniff:
+            print("  Mode : listen only, decoding another master's traffic")
+            metrics.gauges[f'sniff_frames_{n}'] = lambda bus=bus: bus.parser.frames
+            metrics.gauges[f'sniff_resync_bytes_{n}'] = lambda bus=bus: bus.parser.dropped
     print(f"Read Timeout    : {read_timeout}s")
+    for interval, plan in classes:
+        names = ', '.join(name for _, _, parts in plan for name, _, _ in parts)
+        print(f"Poll Every {interval:g}s : {names}")
+    print(f"Bus Duty Cycle  : {duty_cycle:.0%}")
     print(f"Queries Delay   : {queries_delay}s")
     print(f"Next Bat. Delay : {next_battery_delay}s")
+    print(f"Read Max Gap    : {read_max_gap} regs")
+    print(f"Read Max Span   : {read_max_span} regs")
+    if history_store:
+        print(f"History         : {history_store.directory}, {history_store.raw_capacity} raw samples per field")
     print("-" * 112)
 
-    num_batt = config.get('num_batteries', 1)
-    queries = {
-        i: {
-            'block_voltage': getattr(protocol, f'bat_{i}_get_block_voltage'),
-            'cells_voltage': getattr(protocol, f'bat_{i}_get_cells_voltage'),
-            'temperature': getattr(protocol, f'bat_{i}_get_temperature'),
-            'extra_temperature': getattr(protocol, f'bat_{i}_get_extra_temperature')
-        }
-        for i in range(1, num_batt + 1)
-    }
+    # Optional one-shot probe of the largest read the firmware accepts
+    if config.get('probe_read_span', False) and not buses[0].sniff:
+        bus = buses[0]
+        if bus.gateway.acquire():
+            span = probe_max_span(bus.gateway, bus.batteries[0][1], delay=queries_delay)
+            bus.gateway.release()
+            print(f"Largest accepted read span: {span} regs (set read_max_span to at most this)")
+            print("-" * 112)
 
-    # Main loop
-    while True:
-        time.sleep(read_timeout)
+    # Shared decode/publish stage, runs on the event loop thread
+    console_data = {}
+    console_printed = {}
+    def handle_battery(i, addr, bufs):
         try:
-            gateway.open()
-            for i in range(1, num_batt + 1):
-                if i > 1:
-                    time.sleep(next_battery_delay)
-                q = queries[i]
-                # Block voltage
-                time.sleep(queries_delay)
-                gateway.send(q['block_voltage'])
-                bv = gateway.recv(37)
-                if not valid_len(bv, 37):
-                    bv = None
-                # Cells voltage
-                time.sleep(queries_delay)
-                gateway.send(q['cells_voltage'])
-                cv = gateway.recv(37)
-                if not valid_len(cv, 37):
-                    cv = None
-                # Temperature
-                time.sleep(queries_delay)
-                gateway.send(q['temperature'])
-                tv = gateway.recv(13)
-                if not valid_len(tv, 13):
-                    tv = None
-                # Extra temperature
-                et = None
-                if tv:
-                    time.sleep(queries_delay)
-                    gateway.send(q['extra_temperature'])
-                    et = gateway.recv(25)
-                    if not valid_len(et, 25):
-                        et = None
-                # Process
-                data = process_battery_data(i, bv, cv, tv)
-                mos_t, env_t = process_extra_temperature(et)
-                # Filter invalid
-                if data['voltage'] is None or not (volt_min_limit <= data['voltage'] <= volt_max_limit):
-                    continue
-                if data['soc'] is None or not (0 <= data['soc'] <= 100):
-                    continue
-                if data['current'] is None:
+            started = time.perf_counter()
+            values, rejected = regmap.decode(bufs)
+            metrics.stage('decode', time.perf_counter() - started)
+            # A polled window with required fields that is unusable drops the whole update
+            for name in bufs:
+                window = regmap.windows.get(name)
+                if window is None or not window.required:
                     continue
-                # Console output
-                print(f"Battery {i} SOC: {data['voltage']} V, Charged: {data['soc']} %, Cycles: {data['cycle']}, Current: {data['current']} A, Power: {data['power']} W")
-                if data['cells']:
-                    print(f"Battery {i} Cells: {', '.join(str(v) for v in data['cells'])}")
-                if data['temps']:
-                    print(f"Battery {i} Temps: {', '.join(str(t) for t in data['temps'])}°C")
-                if mos_t is not None and env_t is not None:
-                    print(f"Battery {i} MOS Temp: {mos_t}°C, ENV Temp: {env_t}°C")
-                print("-" * 112)
-                # Publish
-                publish_sensors(client, i, data, mos_t, env_t, battery_model)
-            gateway.close()
+                if name in rejected:
+                    metrics.error(i, 'out_of_range')
+                    return
+                if window.required[0].name not in values:
+                    return
+            if not values:
+                return
+            filter_spikes(i, values)
+            # Publish
+            started = time.perf_counter()
+            sensors = publish_sensors(publisher, i, values, battery_model)
+            metrics.stage('publish', time.perf_counter() - started)
+            if history_store:
+                history_store.record(i, time.time(), [(s[0], s[4]) for s in sensors])
+            if stack:
+                aggregates = stack.update(i, time.monotonic(), values)
+                publish_aggregates(publisher, i, aggregates, stack, battery_model)
+            # Console output, merged over the query classes and at most once per read_timeout
+            snapshot = console_data.setdefault(i, {})
+            snapshot.update((k, v) for k, v in values.items() if v is not None)
+            now = time.monotonic()
+            if now - console_printed.get(i, 0) < read_timeout or 'voltage' not in snapshot:
+                return
+            console_printed[i] = now
+            d = snapshot
+            print(f"Battery {i} SOC: {d['voltage']} V, Charged: {d.get('soc')} %, Cycles: {d.get('cycle')}, Current: {d.get('current')} A, Power: {d.get('power')} W")
+            # Remaining fields grouped by window, in register map order
+            shown = {'voltage', 'soc', 'cycle', 'current', 'power'}
+            for window in regmap.windows.values():
+                fields = [f for f in window.fields if f.name in d and f.name not in shown]
+                units = {f.unit or '' for f in fields}
+                if len(fields) > 2 and len(units) == 1:
+                    # Repeated registers (cells, sensors) on one line under the window's name
+                    title = window.name.replace('_', ' ').title()
+                    print(f"Battery {i} {title}: {', '.join(str(d[f.name]) for f in fields)}{units.pop()}")
+                elif fields:
+                    print(f"Battery {i} " + ', '.join(f"{f.label}: {d[f.name]}{f.unit or ''}" for f in fields))
+            print(f"MQTT states sent: {publish_stats['state_sent']}, unchanged skipped: {publish_stats['state_suppressed']}, "
+                  f"configs sent: {publish_stats['config_sent']}, skipped: {publish_stats['config_suppressed']}, "
+                  f"superseded in queue: {publisher.coalesced}, backlog: {publisher.backlog()}")
+            print("-" * 112)
         except Exception as e:
-            print("Error:", e)
-            time.sleep(read_timeout)
+            print(f"Error on battery {i}:", e)
+
+    # Diagnostics: HA entities at a low rate, Prometheus endpoint on demand
+    tasks = []
+    diagnostics_interval = config.get('diagnostics_interval', 300)
+    if diagnostics_interval:
+        async def diagnostics_loop():
+            while True:
+                await asyncio.sleep(diagnostics_interval)
+                try:
+                    # Batteries found or lost at runtime come and go with the schedule
+                    indexes = sorted(index for bus in buses for index in bus.active)
+                    publish_diagnostics(publisher, indexes, buses, battery_model)
+                except Exception as e:
+                    print("Error publishing diagnostics:", e)
+        tasks.append(diagnostics_loop())
+    metrics.gauges['mqtt_backlog'] = publisher.backlog
+    metrics.gauges['mqtt_superseded'] = lambda: publisher.coalesced
+    metrics.gauges['mqtt_dropped'] = lambda: publisher.dropped
+    metrics_port = config.get('metrics_port', 0)
+    if metrics_port:
+        print(f"Prometheus metrics on port {metrics_port}")
+        tasks.append(serve_prometheus(metrics_port))
+
+    if history_store:
+        async def history_loop():
+            flushed = time.monotonic()
+            while True:
+                await asyncio.sleep(0.5)
+                while history_requests:
+                    try:
+                        request = json.loads(history_requests.pop(0))
+                    except ValueError:
+                        request = {}
+                    if not isinstance(request, dict):
+                        request = {}
+                    reply = history.answer(history_store, request, time.time())
+                    mqtt_publish(publisher, request.get('reply_to') or history.RESULT_TOPIC,
+                                 json.dumps(reply, separators=(',', ':')), 'reply')
+                if time.monotonic() - flushed >= 60:
+                    history_store.flush()
+                    flushed = time.monotonic()
+        tasks.append(history_loop())
+
+    if stack:
+        async def stack_loop():
+            while True:
+                await asyncio.sleep(60)
+                stack.expire(time.monotonic())
+                stack.save()
+        tasks.append(stack_loop())
+
+    # Modbus TCP server for other clients of the batteries, answered from the register image
+    modbus_server_port = config.get('modbus_server_port', 0)
+    if modbus_server_port:
+        max_age = to_float(config.get('modbus_server_max_age', 5), 'modbus_server_max_age')
+        image = RegisterImage()
+        for bus in buses:
+            bus.image = image
+        print(f"Modbus TCP server on port {modbus_server_port}, max register age {max_age:g}s")
+        tasks.append(serve_modbus(image, buses, max_age, modbus_server_port))
+
+    # Raw frame capture of every bus exchange
+    if config.get('capture', False):
+        capture_dir = '/data/capture' if os.path.isdir('/data') else 'capture'
+        max_mb = to_float(config.get('capture_max_mb', 10), 'capture_max_mb')
+        writer = capture.CaptureWriter(capture_dir, int(max_mb * 1024 * 1024))
+        for bus in buses:
+            bus.gateway.capture = writer
+        print(f"Capturing bus traffic to {writer.path}")
+
+    # Replay a capture through decode and publish instead of polling
+    replay_file = config.get('replay_capture', '')
+    if replay_file:
+        speed = to_float(config.get('replay_speed', 0), 'replay_speed')
+        batteries = {addr: index for bus in buses for index, addr in bus.batteries}
+        # Replayed samples are from the past, they must not land in today's history
+        history_store = None
+        started = time.monotonic()
+        count = asyncio.run(capture.replay(replay_file, batteries, handle_battery, speed))
+        elapsed = time.monotonic() - started
+        print(f"Replayed {count} replies from {replay_file} in {elapsed:.2f}s ({count / max(elapsed, 1e-9):.0f}/s)")
+        deadline = time.monotonic() + 10
+        while publisher.backlog() > 0 and time.monotonic() < deadline:
+            time.sleep(0.1)  # let queued MQTT messages go out
+        client.loop_stop()
+        sys.exit(0)
+
+    # The add-on is stopped with SIGTERM: exit normally so the atexit handlers still run
+    signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+
+    # Main loop
+    asyncio.run(poll_engine.run(buses, handle_battery, *tasks))
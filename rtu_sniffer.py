@@ -0,0 +1,104 @@
+# rtu_sniffer.py
+#
+# Listen-only Modbus RTU decoding: another master (e.g. the inverter) polls
+# the batteries and the add-on only watches the bus. Raw bytes arrive in
+# arbitrary chunks; frames are found by their CRC, a silence on the line
+# ends whatever could not be framed, and every function 0x03 reply is paired
+# with the request before it so its registers are known.
+
+import protocol
+
+# Longest RTU frame; with some slack this bounds the parser's buffer
+MAX_FRAME = 256
+MAX_BUFFER = 2 * MAX_FRAME
+
+REQUEST_LEN = 8
+EXCEPTION_LEN = 5
+
+def crc_ok(buf, length):
+    return protocol.crc16(buf[:length - 2]) == int.from_bytes(buf[length - 2:length], 'little')
+
+class RtuParser:
+    """Incremental frame parser, feed() it chunks as they come off the bus."""
+    def __init__(self, char_time=0.0, gap=None):
+        self.char_time = char_time
+        self.gap = gap           # silence (s) after which unframed bytes are dropped
+        self.buf = bytearray()
+        self.pending = None      # (addr, start, count) of the last request seen
+        self.last_rx = None
+        self.frames = 0
+        self.dropped = 0         # bytes skipped while resyncing
+
+    def feed(self, data, now):
+        """Returns (addr, start, count, reply frame) for every completed 0x03 exchange."""
+        # The chunk itself took len(data) characters on the wire before `now`
+        silence = now - len(data) * self.char_time - (self.last_rx or now)
+        if self.gap is not None and silence > self.gap:
+            # A frame never spans a silence: whatever is left cannot complete
+            self.dropped += len(self.buf)
+            self.buf.clear()
+        self.last_rx = now
+        self.buf += data
+        out = []
+        while True:
+            length = self._frame_length()
+            if length is None:
+                break
+            if not length:
+                del self.buf[0]
+                self.dropped += 1
+                continue
+            frame = bytes(self.buf[:length])
+            del self.buf[:length]
+            self.frames += 1
+            exchange = self._pair(frame)
+            if exchange:
+                out.append(exchange)
+        if len(self.buf) > MAX_BUFFER:
+            self.dropped += len(self.buf) - MAX_FRAME
+            del self.buf[:-MAX_FRAME]
+        return out
+
+    def _frame_length(self):
+        """Length of the frame at the start of the buffer, 0 if there is none, None to wait."""
+        buf = self.buf
+        if len(buf) < EXCEPTION_LEN:
+            return None
+        func = buf[1]
+        if func == protocol.READ_HOLDING | 0x80:
+            return EXCEPTION_LEN if crc_ok(buf, EXCEPTION_LEN) else 0
+        if func != protocol.READ_HOLDING:
+            return 0
+        # Requests are 8 bytes, 0x03 replies always an odd length; the reply the
+        # last request asked for is tried first
+        candidates = []
+        if self.pending and self.pending[0] == buf[0] and buf[2] == 2 * self.pending[2]:
+            candidates.append(protocol.response_len(self.pending[2]))
+        candidates.append(REQUEST_LEN)
+        if buf[2] % 2 == 0:
+            candidates.append(5 + buf[2])
+        waiting = False
+        for length in candidates:
+            if len(buf) < length:
+                waiting = True
+            elif crc_ok(buf, length):
+                return length
+        return None if waiting else 0
+
+    def _pair(self, frame):
+        addr = frame[0]
+        if frame[1] & 0x80:
+            self.pending = None
+            return None
+        if len(frame) == REQUEST_LEN:
+            self.pending = (addr, int.from_bytes(frame[2:4], 'big'), int.from_bytes(frame[4:6], 'big'))
+            return None
+        pending, self.pending = self.pending, None
+        if pending and pending[0] == addr and len(frame) == protocol.response_len(pending[2]):
+            return pending[0], pending[1], pending[2], frame
+        return None
+
+def covered_windows(windows, start, count):
+    """(name, start, count) of the windows lying entirely inside a read of start..start+count."""
+    end = start + count
+    return [(name, s, c) for name, (s, c) in windows.items() if start <= s and s + c <= end]
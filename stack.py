@@ -0,0 +1,208 @@
+# stack.py
+#
+# Aggregates over the whole battery stack, kept up to date as samples come
+# in instead of being recomputed: per battery cell spread and average
+# temperature, stack power, current and capacity as running sums, the weakest
+# battery from a heap, and charge / discharge counters integrated from
+# power and current at the real sample times. The counters survive
+# restarts in a small JSON file.
+
+import heapq
+import json
+import os
+
+# Entities: key -> (name, device class, unit, state class)
+BATTERY_SENSORS = {
+    'cell_delta': ('Cell Delta', 'voltage', 'mV', 'measurement'),
+    'cell_min_index': ('Lowest Cell', None, None, None),
+    'cell_max_index': ('Highest Cell', None, None, None),
+    'temp_avg': ('Average Temperature', 'temperature', '°C', 'measurement'),
+}
+STACK_SENSORS = {
+    'power': ('Power', 'power', 'W', 'measurement'),
+    'current': ('Current', 'current', 'A', 'measurement'),
+    'soc': ('SOC', 'battery', '%', 'measurement'),
+    'weakest_battery': ('Weakest Battery', None, None, None),
+    'energy_charged': ('Energy Charged', 'energy', 'kWh', 'total_increasing'),
+    'energy_discharged': ('Energy Discharged', 'energy', 'kWh', 'total_increasing'),
+    'charge_ah': ('Charge In', None, 'Ah', 'total_increasing'),
+    'discharge_ah': ('Charge Out', None, 'Ah', 'total_increasing'),
+}
+
+COUNTERS = ('charged_wh', 'discharged_wh', 'charged_ah', 'discharged_ah')
+
+def split_area(v0, v1, dt):
+    """Trapezoid area of a linear v0 -> v1 over dt, as (positive part, negative part magnitude)."""
+    if v0 >= 0 and v1 >= 0:
+        return (v0 + v1) / 2 * dt, 0.0
+    if v0 <= 0 and v1 <= 0:
+        return 0.0, -(v0 + v1) / 2 * dt
+    # Crosses zero in between
+    f = v0 / (v0 - v1)
+    first, second = v0 * f * dt / 2, v1 * (1 - f) * dt / 2
+    return (first, -second) if v0 > 0 else (second, -first)
+
+class BatteryState:
+    __slots__ = ('t', 'power', 'current', 'soc', 'remaining', 'full', 'seq') + COUNTERS
+
+    def __init__(self):
+        self.t = self.power = self.current = self.soc = self.remaining = self.full = None
+        self.seq = 0
+        for name in COUNTERS:
+            setattr(self, name, 0.0)
+
+class Stack:
+    def __init__(self, cell_fields, temp_fields, path, max_gap=60):
+        """`max_gap` (s): two samples further apart are not integrated, the
+        battery was not heard in between.
+        """
+        self.cell_fields = list(cell_fields)
+        self.temp_fields = list(temp_fields)
+        self.path = path
+        self.max_gap = max_gap
+        self.batteries = {}
+        self.power = 0.0
+        self.current = 0.0
+        self.soc_sum = 0.0
+        self.soc_count = 0
+        self.remaining = 0.0  # Ah left in the batteries reporting their capacity
+        self.full = 0.0       # Ah of those batteries when fully charged
+        self.totals = dict.fromkeys(COUNTERS, 0.0)
+        self._weakest = []  # (soc, index, seq), stale entries skipped lazily
+        self._load()
+
+    def _battery(self, index):
+        b = self.batteries.get(index)
+        if b is None:
+            b = self.batteries[index] = BatteryState()
+        return b
+
+    def update(self, index, t, values):
+        """Fold one battery update (name -> value, monotonic time t) in; returns its per battery aggregates."""
+        b = self._battery(index)
+        power = values.get('power')
+        current = values.get('current')
+        if power is not None or current is not None:
+            if b.t is not None and 0 < t - b.t <= self.max_gap:
+                dt = t - b.t
+                if power is not None and b.power is not None:
+                    charged, discharged = split_area(b.power, power, dt / 3600)
+                    self._count(b, 'charged_wh', charged)
+                    self._count(b, 'discharged_wh', discharged)
+                if current is not None and b.current is not None:
+                    charged, discharged = split_area(b.current, current, dt / 3600)
+                    self._count(b, 'charged_ah', charged)
+                    self._count(b, 'discharged_ah', discharged)
+            b.t = t
+            if power is not None:
+                self.power += power - (b.power or 0.0)
+                b.power = power
+            if current is not None:
+                self.current += current - (b.current or 0.0)
+                b.current = current
+        soc = values.get('soc')
+        if soc is not None:
+            if b.soc is None:
+                self.soc_count += 1
+            self.soc_sum += soc - (b.soc or 0.0)
+            b.soc = soc
+            b.seq += 1
+            heapq.heappush(self._weakest, (soc, index, b.seq))
+            if len(self._weakest) > 4 * len(self.batteries) + 16:
+                self._weakest = [(x.soc, i, x.seq) for i, x in self.batteries.items() if x.soc is not None]
+                heapq.heapify(self._weakest)
+        remaining = values.get('remaining_capacity')
+        full = values.get('full_capacity')
+        if remaining is not None and full:
+            self.remaining += remaining - (b.remaining or 0.0)
+            self.full += full - (b.full or 0.0)
+            b.remaining, b.full = remaining, full
+
+        out = {}
+        cells = [(values[name], n) for n, name in enumerate(self.cell_fields, start=1)
+                 if values.get(name) is not None]
+        if cells:
+            low, high = min(cells), max(cells)
+            out['cell_delta'] = high[0] - low[0]
+            out['cell_min_index'] = low[1]
+            out['cell_max_index'] = high[1]
+        temps = [values[name] for name in self.temp_fields if values.get(name) is not None]
+        if temps:
+            out['temp_avg'] = round(sum(temps) / len(temps), 1)
+        return out
+
+    def remove(self, index):
+        """Take a silent or retired battery out of the stack sums, its counters are kept."""
+        b = self.batteries.get(index)
+        if b is None:
+            return
+        self.power -= b.power or 0.0
+        self.current -= b.current or 0.0
+        if b.soc is not None:
+            self.soc_sum -= b.soc
+            self.soc_count -= 1
+        self.remaining -= b.remaining or 0.0
+        self.full -= b.full or 0.0
+        b.t = b.power = b.current = b.soc = b.remaining = b.full = None
+        b.seq += 1  # its heap entries are stale now
+
+    def expire(self, now):
+        """Remove the batteries not heard for longer than max_gap before `now`."""
+        for index, b in list(self.batteries.items()):
+            if b.t is not None and now - b.t > self.max_gap:
+                self.remove(index)
+
+    def _count(self, b, name, amount):
+        setattr(b, name, getattr(b, name) + amount)
+        self.totals[name] += amount
+
+    def weakest(self):
+        heap = self._weakest
+        while heap and heap[0][2] != self.batteries[heap[0][1]].seq:
+            heapq.heappop(heap)
+        return heap[0][1] if heap else None
+
+    def soc(self):
+        # Capacity weighted: the stack's remaining Ah over its full Ah, the mean
+        # SOC only while no battery reported its capacity
+        if self.full > 0:
+            return round(100 * self.remaining / self.full, 1)
+        return round(self.soc_sum / self.soc_count, 1) if self.soc_count else None
+
+    def summary(self):
+        """Stack entities, keys as in STACK_SENSORS."""
+        return {
+            'power': round(self.power, 1),
+            'current': round(self.current, 2),
+            'soc': self.soc(),
+            'weakest_battery': self.weakest(),
+            'energy_charged': round(self.totals['charged_wh'] / 1000, 3),
+            'energy_discharged': round(self.totals['discharged_wh'] / 1000, 3),
+            'charge_ah': round(self.totals['charged_ah'], 2),
+            'discharge_ah': round(self.totals['discharged_ah'], 2),
+        }
+
+    def _load(self):
+        try:
+            with open(self.path) as f:
+                saved = json.load(f)
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            print(f"Stack counters not loaded, starting from 0: {e}")
+            return
+        for index, counters in saved.get('batteries', {}).items():
+            b = self._battery(int(index))
+            for name in COUNTERS:
+                self._count(b, name, float(counters.get(name, 0.0)))
+
+    def save(self):
+        data = {'batteries': {str(index): {name: getattr(b, name) for name in COUNTERS}
+                              for index, b in self.batteries.items()}}
+        tmp = self.path + '.tmp'
+        try:
+            with open(tmp, 'w') as f:
+                json.dump(data, f)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            print(f"Stack counters not saved: {e}")
@@ -0,0 +1,7 @@
+import os
+import sys
+
+# The add-on's modules live in the repository root, the tools next to them
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.join(ROOT, 'tools'))
@@ -0,0 +1,43 @@
+# The register map and the batch decoder against the hex string decoders
+# shipped up to 1.8.4, on the same frames.
+
+import random
+
+import pytest
+
+import decoders
+import register_map
+from bench_decoders import disagreements, make_frames, reply
+
+def frame_sets():
+    rng = random.Random(8)
+    sets = [make_frames(rng) for _ in range(300)]
+    bv, cv, tv, et = sets[0]
+    sets += [
+        # Cells out of range, fewer than 8 left
+        (bv, reply(1, [2000] * 10 + [3300] * 6), tv, et),
+        # A few cells out of range, the rest kept
+        (bv, reply(1, [5000, 2000] + [3300] * 14), tv, et),
+        # Temperatures outside the plausible range
+        (bv, cv, reply(1, [726 - 250, 726 + 600, 726, 726 + 100]), reply(1, [726 + 700, 726 - 300] + [0] * 8)),
+        # Block voltage and SOC outside their limits
+        (reply(1, [0, 7000, 1200] + [0] * 13), cv, tv, et),
+        # Truncated and missing replies
+        (bv, cv[:-3], tv[:-3], None),
+        (None, None, None, None),
+    ]
+    return sets
+
+@pytest.mark.parametrize('frames', frame_sets())
+def test_register_map_matches_legacy(frames):
+    assert disagreements(*frames) == []
+
+def test_batch_matches_per_frame():
+    rng = random.Random(9)
+    capture = [make_frames(rng)[0] for _ in range(500)]
+    columns = decoders.decode_window_batch('block_voltage', capture)
+    for n, frame in enumerate(capture):
+        values, _ = register_map.MAP.decode({'block_voltage': frame})
+        # The batch columns are not rounded
+        assert {name: float(column[n]) for name, column in columns.items()} == \
+            pytest.approx(values, abs=0.01)
@@ -0,0 +1,24 @@
+# An unplugged USB-RS485 adapter must end the cycle, not the add-on.
+
+import errno
+
+from poll_engine import Bus
+
+class UnpluggedSerial:
+    is_open = True
+
+    @property
+    def in_waiting(self):
+        raise OSError(errno.EIO, "Input/output error")
+
+    def close(self):
+        pass
+
+def test_unplugged_adapter_fails_the_cycle():
+    bus = Bus('serial 1', {'connection_type': 'serial', 'serial_port': '/dev/ritar-missing'}, [(1, 1)], [])
+    bus._reads = {(1, 0): []}
+    bus.gateway._serial = UnpluggedSerial()
+    assert bus.poll_task(1, 1, 0) is None
+    assert not bus.gateway.is_open
+    bus.gateway._serial = UnpluggedSerial()
+    assert bus.probe(1, 1) is False
@@ -0,0 +1,17 @@
+# Aggregates must count every recorded sample, also when the raw ring no
+# longer reaches back and the answer comes from the rollups.
+
+import pytest
+
+from history import HistoryStore
+
+def test_aggregate_counts_every_sample(tmp_path):
+    store = HistoryStore(str(tmp_path), 50, ['voltage'])
+    t0 = 1700000030.0
+    for n in range(300):
+        store.record(1, t0 + 2 * n, [('voltage', 50 + n % 7)])
+    result = store.aggregate(1, 'voltage', t0, t0 + 2 * 299)
+    assert result['resolution'] == '1m'
+    assert result['count'] == 300
+    assert result['mean'] == pytest.approx(sum(50 + n % 7 for n in range(300)) / 300, abs=0.001)
+    assert result['covered'][0] <= t0 and result['covered'][1] == t0 + 2 * 299
@@ -0,0 +1,43 @@
+# Listen-only mode through the real gateway path: bytes that arrive while a
+# chunk is being handled must still reach the parser.
+
+import socket
+import threading
+import time
+
+import protocol
+from bms_simulator import SimulatedStack
+from poll_engine import Bus
+
+EXCHANGES = 300
+
+def serve_traffic(server, period):
+    """Another master's traffic: one request/reply pair every `period` seconds."""
+    stack = SimulatedStack([1], seed=1)
+    conn, _ = server.accept()
+    with conn:
+        for _ in range(EXCHANGES):
+            request = protocol.build_read(1, 0x0000, 16)
+            conn.sendall(request + stack.handle(request))
+            time.sleep(period)
+        time.sleep(0.5)
+
+def test_slow_consumer_loses_no_exchange():
+    server = socket.socket()
+    server.bind(('127.0.0.1', 0))
+    server.listen(1)
+    cfg = {'connection_type': 'ethernet', 'rs485gate_ip': '127.0.0.1',
+           'rs485gate_port': server.getsockname()[1], 'sniff_mode': True}
+    bus = Bus('gateway 1', cfg, [(1, 1)], [])
+    master = threading.Thread(target=serve_traffic, args=(server, 0.004), daemon=True)
+    master.start()
+    decoded = 0
+    deadline = time.monotonic() + 20
+    while (master.is_alive() or bus.gateway.is_open) and time.monotonic() < deadline:
+        replies = bus.sniff_chunk()
+        if not replies and not master.is_alive():
+            break
+        decoded += sum(1 for _, _, bufs in replies if bufs.get('block_voltage'))
+        time.sleep(0.006)  # decode and publish taking longer than the master's period
+    server.close()
+    assert decoded == EXCHANGES
@@ -0,0 +1,113 @@
+#!/usr/bin/env python3
+# bench_cycle.py
+#
+# End to end polling benchmark: runs the real ritar-bms.py against the BMS
+# simulator and an MQTT stand-in, then reports the achieved polling interval
+# per register window (the cycle time of that query class), bus utilisation,
+# publishes per second, CPU time and peak RSS of the add-on process.
+#
+#   python3 tools/bench_cycle.py --batteries 16 --duration 60 --latency 0.03
+
+import argparse
+import json
+import os
+import resource
+import signal
+import subprocess
+import sys
+import tempfile
+import time
+
+import yaml
+
+TOOLS = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.join(TOOLS, '..')
+sys.path.insert(0, ROOT)
+
+import protocol
+from bms_simulator import SimulatedStack, serve_tcp
+from mqtt_standin import MqttStandIn
+
+def intervals(log):
+    """Achieved time between reads of the same window on the same battery, by start register."""
+    last = {}
+    per_window = {}
+    for seen, _, addr, start in sorted(log):
+        if (addr, start) in last:
+            per_window.setdefault(start, []).append(seen - last[(addr, start)])
+        last[(addr, start)] = seen
+    return per_window
+
+def main():
+    parser = argparse.ArgumentParser(description='Ritar BMS polling cycle benchmark')
+    parser.add_argument('--batteries', type=int, default=4)
+    parser.add_argument('--duration', type=float, default=30, help='seconds to run the add-on')
+    parser.add_argument('--latency', type=float, default=0.02, help='simulated BMS reply latency')
+    parser.add_argument('--jitter', type=float, default=0.01)
+    parser.add_argument('--drop', type=float, default=0.0)
+    parser.add_argument('--option', action='append', default=[], metavar='KEY=JSON',
+                        help='extra add-on option, e.g. --option read_max_span=56')
+    args = parser.parse_args()
+
+    stack = SimulatedStack([protocol.battery_address(i) for i in range(1, args.batteries + 1)],
+                           latency=args.latency, jitter=args.jitter, drop=args.drop, seed=1)
+    bms_port = serve_tcp(stack, port=0)
+    broker = MqttStandIn()
+
+    options = {
+        'connection_type': 'ethernet',
+        'rs485gate_ip': '127.0.0.1',
+        'rs485gate_port': bms_port,
+        'connection_timeout': 1,
+        'num_batteries': args.batteries,
+        'next_battery_delay': 0,
+        'mqtt_broker': '127.0.0.1',
+        'mqtt_port': broker.port,
+    }
+    # The add-on's shipped polling rates, unset ones would all fall back to read_timeout
+    with open(os.path.join(ROOT, 'config.yaml')) as f:
+        shipped = yaml.safe_load(f)['options']
+    options.update({key: value for key, value in shipped.items() if key.endswith('_interval')})
+    for opt in args.option:
+        key, _, value = opt.partition('=')
+        options[key] = json.loads(value)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        with open(os.path.join(workdir, 'config.yaml'), 'w') as f:
+            json.dump({'options': options}, f)  # JSON is valid YAML
+        with open(os.path.join(workdir, 'addon.log'), 'w') as log:
+            proc = subprocess.Popen([sys.executable, '-u', os.path.abspath(os.path.join(ROOT, 'ritar-bms.py'))],
+                                    cwd=workdir, stdout=log, stderr=subprocess.STDOUT)
+            time.sleep(args.duration)
+            proc.send_signal(signal.SIGINT)
+            try:
+                proc.wait(5)
+            except subprocess.TimeoutExpired:
+                proc.kill()
+                proc.wait()
+        usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+        log = stack.log
+        if len(log) < 2:
+            with open(os.path.join(workdir, 'addon.log')) as f:
+                print(f.read()[-2000:])
+            sys.exit("No queries seen, increase --duration")
+
+    first, last = log[0][0], log[-1][0]
+    span = last - first
+    published = [m for m in broker.messages if first <= m[0] <= last]
+    configs = sum(1 for m in published if m[1].endswith('/config'))
+    missed = sum(1 for _, r, _, _ in log if r is None)
+    busy = sum(r - s for s, r, _, _ in log if r is not None)
+
+    print(f"Batteries           : {args.batteries}")
+    print(f"Queries             : {len(log)} in {span:.1f} s ({missed} unanswered)")
+    for start, gaps in sorted(intervals(log).items()):
+        print(f"Window 0x{start:04x} interval: mean {sum(gaps) / len(gaps):.2f} s, max {max(gaps):.2f} s")
+    print(f"Bus utilisation     : {busy / span:.0%}")
+    print(f"Publishes per second: {len(published) / span:.1f} ({configs} discovery configs in total)")
+    print(f"MQTT bytes per sec. : {sum(m[2] for m in published) / span:.0f}")
+    print(f"CPU time            : {usage.ru_utime + usage.ru_stime:.2f} s over {args.duration:.0f} s")
+    print(f"Peak RSS            : {usage.ru_maxrss / 1024:.1f} MiB")
+
+if __name__ == '__main__':
+    main()
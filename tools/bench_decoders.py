@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+# bench_decoders.py
+#
+# Microbenchmark: hex string decoders (up to 1.8.4) against the compiled
+# register map decoders, plus per-frame vs batch decoding of a long capture.
+# Also checks that old and new decoders agree on every generated frame.
+#
+#   python3 tools/bench_decoders.py [--frames 20000]
+
+import argparse
+import binascii
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import decoders
+import register_map
+import protocol
+
+# --- Reference decoders as shipped up to 1.8.4 ---
+CELL_MIN_LIMIT, CELL_MAX_LIMIT = 2450, 4750
+VOLT_MIN_LIMIT, VOLT_MAX_LIMIT = 40.00, 60.00
+TEMP_MIN_LIMIT, TEMP_MAX_LIMIT = -20, 55
+
+def valid_len(buf, length):
+    return buf is not None and len(buf) == length
+
+def legacy_hex_to_temperature(hex_str):
+    pairs = [hex_str[i:i+2] for i in range(0, len(hex_str), 2)]
+    data = pairs[3:-2]
+    if len(data) % 2:
+        data = data[:-1]
+    temps = []
+    for i in range(0, len(data), 2):
+        raw = int(data[i] + data[i+1], 16)
+        temps.append(round((raw - 726) * 0.1 + 22.6, 1))
+    return temps
+
+def legacy_process_extra_temperature(data):
+    if not valid_len(data, 25):
+        return None, None
+    hx = binascii.hexlify(data).decode()
+    mos = round((int(hx[6:10], 16) - 726) * 0.1 + 22.6, 1)
+    env = round((int(hx[10:14], 16) - 726) * 0.1 + 22.6, 1)
+    mos_valid = mos if TEMP_MIN_LIMIT <= mos <= TEMP_MAX_LIMIT else None
+    env_valid = env if TEMP_MIN_LIMIT <= env <= TEMP_MAX_LIMIT else None
+    return mos_valid, env_valid
+
+def legacy_process_battery_data(index, block_buf, cells_buf, temp_buf):
+    result = {'voltage': None, 'soc': None, 'cycle': None, 'current': None,
+              'power': None, 'cells': None, 'temps': None}
+    if valid_len(block_buf, 37):
+        hb = binascii.hexlify(block_buf).decode()
+        cur_raw = int(hb[6:10], 16)
+        if cur_raw >= 0x8000:
+            cur_raw -= 0x10000
+        current = round(cur_raw / 100, 2)
+        voltage = round(int(hb[10:14], 16) / 100, 2)
+        soc = round(int(hb[14:18], 16) / 10, 1)
+        cycle = int(hb[34:38], 16)
+        power = round(current * voltage, 2)
+        result.update({'current': current, 'voltage': voltage, 'soc': soc, 'cycle': cycle, 'power': power})
+    if valid_len(cells_buf, 37) and cells_buf[0] == index:
+        hv = binascii.hexlify(cells_buf).decode()
+        raw_cells = [int(hv[6 + 4*i:10 + 4*i], 16) for i in range(16)]
+        filtered = [v if CELL_MIN_LIMIT <= v <= CELL_MAX_LIMIT else None for v in raw_cells]
+        if len([v for v in filtered if v is not None]) >= 8:
+            result['cells'] = filtered
+    if valid_len(temp_buf, 13):
+        temps = legacy_hex_to_temperature(binascii.hexlify(temp_buf).decode())
+        result['temps'] = [t for t in temps if TEMP_MIN_LIMIT <= t <= TEMP_MAX_LIMIT]
+    return result
+
+# --- Realistic frames ---
+def reply(addr, regs):
+    body = bytes((addr, 0x03, 2 * len(regs))) + b''.join((r & 0xFFFF).to_bytes(2, 'big') for r in regs)
+    return body + protocol.crc16(body).to_bytes(2, 'little')
+
+def make_frames(rng, addr=1):
+    block = [rng.randint(-6000, 6000), rng.randint(4800, 5600), rng.randint(0, 1000)] + [0] * 4
+    block += [rng.randint(0, 3000)] + [0] * 8
+    cells = [rng.randint(3200, 3450) for _ in range(16)]
+    temps = [726 + rng.randint(-30, 300) for _ in range(4)]
+    extra = [726 + rng.randint(-30, 300), 726 + rng.randint(-30, 200)] + [0] * 8
+    return reply(addr, block), reply(addr, cells), reply(addr, temps), reply(addr, extra)
+
+def map_decode(bv, cv, tv, et):
+    return register_map.MAP.decode({'block_voltage': bv, 'cells_voltage': cv,
+                                    'temperature': tv, 'extra_temperature': et})
+
+def disagreements(bv, cv, tv, et):
+    """Differences between the 1.8.4 decoders and the register map on one frame set."""
+    old = legacy_process_battery_data(1, bv, cv, tv)
+    mos, env = legacy_process_extra_temperature(et)
+    values, rejected = map_decode(bv, cv, tv, et)
+    diffs = []
+    def check(name, new, expected):
+        if new != expected:
+            diffs.append((name, new, expected))
+    if 'block_voltage' in rejected:
+        # The map drops the block on its limits, the old code checked them after decoding
+        check('block limits', True, not (VOLT_MIN_LIMIT <= old['voltage'] <= VOLT_MAX_LIMIT
+                                         and 0 <= old['soc'] <= 100))
+    else:
+        for name in ('voltage', 'soc', 'current', 'cycle', 'power'):
+            check(name, values.get(name), old[name])
+    # A window without a usable frame leaves its fields out, the old code its key
+    cells = [values.get(f'cell_{i:02d}') for i in range(1, 17)] if 'cell_01' in values else None
+    check('cells', cells, old['cells'])
+    # Temperatures keep their sensor numbers in the map, the old list dropped implausible ones
+    temps = [values[f'temp_{i}'] for i in range(1, 5) if values.get(f'temp_{i}') is not None]
+    check('temps', temps if 'temp_1' in values else None, old['temps'])
+    check('temp_mos', values.get('temp_mos'), mos)
+    check('temp_env', values.get('temp_env'), env)
+    return diffs
+
+def bench(label, func, number):
+    seconds = min(timeit.repeat(func, number=number, repeat=5))
+    print(f"{label:<44} {seconds / number * 1e6:9.2f} us")
+    return seconds
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument('--frames', type=int, default=20000, help='frames in the batch capture')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    rng = random.Random(args.seed)
+    samples = [make_frames(rng) for _ in range(200)]
+    for frames in samples:
+        assert not disagreements(*frames), disagreements(*frames)
+    print(f"Old and new decoders agree on {len(samples)} frame sets")
+    print("-" * 56)
+
+    bv, cv, tv, et = samples[0]
+    old = bench("block + cells + temps (hex strings)", lambda: legacy_process_battery_data(1, bv, cv, tv), 20000)
+    new = bench("block + cells + temps (register map)", lambda: map_decode(bv, cv, tv, None), 20000)
+    print(f"{'speedup':<44} {old / new:9.2f} x")
+    extra = register_map.MAP.windows['extra_temperature']
+    old = bench("extra temperature (hex strings)", lambda: legacy_process_extra_temperature(et), 50000)
+    new = bench("extra temperature (register map)", lambda: extra.decode(et), 50000)
+    print(f"{'speedup':<44} {old / new:9.2f} x")
+    print("-" * 56)
+
+    block = register_map.MAP.windows['block_voltage']
+    capture = [make_frames(rng)[0] for _ in range(args.frames)]
+    per_frame = bench(f"{args.frames} block frames, one by one",
+                      lambda: [block.decode(f) for f in capture], 1)
+    batch = bench(f"{args.frames} block frames, decode_window_batch",
+                  lambda: decoders.decode_window_batch('block_voltage', capture), 1)
+    backend = 'NumPy' if decoders.np is not None else 'array'
+    print(f"{'speedup (' + backend + ')':<44} {per_frame / batch:9.2f} x")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,178 @@
+#!/usr/bin/env python3
+# bms_simulator.py
+#
+# Stand-in for a stack of Ritar batteries behind an RS485 gate. Speaks the
+# same raw Modbus RTU frames over TCP that ModbusGateway uses (or over a pty
+# for the serial connection type) and answers function 0x03 reads of every
+# register window the add-on knows. Faults can be injected per frame.
+#
+#   python3 tools/bms_simulator.py --batteries 4 --port 50500
+#   python3 tools/bms_simulator.py --batteries 2 --pty --latency 0.02 --drop 0.05
+
+import argparse
+import math
+import os
+import random
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import protocol
+
+class SimulatedStack:
+    """Register images for a set of Modbus addresses plus fault injection."""
+    def __init__(self, addresses, latency=0.0, jitter=0.0, drop=0.0, truncate=0.0, corrupt=0.0, seed=None):
+        self.addresses = set(addresses)
+        self.latency = latency
+        self.jitter = jitter
+        self.drop = drop
+        self.truncate = truncate
+        self.corrupt = corrupt
+        self.rng = random.Random(seed)
+        self.started = time.monotonic()
+        self.lock = threading.Lock()
+        # (monotonic time request seen, monotonic time reply sent or None, address, start register)
+        self.log = []
+
+    def registers(self, addr):
+        """256 holding registers of one battery, drifting slowly with time."""
+        t = time.monotonic() - self.started
+        regs = [0] * 256
+        current = int(1500 * math.sin(t / 30 + addr))
+        regs[0] = current & 0xFFFF
+        regs[1] = 5200 + int(current / 50)
+        regs[2] = 500 + int(300 * math.sin(t / 600 + addr))
+        regs[4] = regs[2] * 10  # 100 Ah battery, 0.01 Ah units
+        regs[5] = 10000
+        regs[7] = 100 + addr
+        regs[0x21] = regs[0]
+        for i in range(16):
+            regs[0x28 + i] = 3300 + int(current / 100) + (i * 7 + addr) % 11
+        for i in range(4):
+            regs[0x78 + i] = 726 + 20 + i + addr + int(5 * math.sin(t / 120))
+        regs[0x91] = 726 + 60 + addr
+        regs[0x92] = 726 + 10
+        regs[0x9b] = 726 + 30 + addr
+        regs[0x9c] = 726 + 25
+        regs[0xef:0xf5] = time.localtime()[:6]  # BMS clock
+        return regs
+
+    def handle(self, request):
+        """Reply bytes for one request frame, or None to stay silent."""
+        if len(request) != 8 or protocol.crc16(request[:6]) != int.from_bytes(request[6:], 'little'):
+            return None
+        addr, func = request[0], request[1]
+        start = int.from_bytes(request[2:4], 'big')
+        count = int.from_bytes(request[4:6], 'big')
+        if addr not in self.addresses or func != protocol.READ_HOLDING:
+            return None
+        if not 1 <= count <= 125 or start + count > 256:
+            body = bytes((addr, func | 0x80, 0x02))  # illegal data address
+            return body + protocol.crc16(body).to_bytes(2, 'little')
+        regs = self.registers(addr)[start:start + count]
+        body = bytes((addr, func, 2 * count)) + b''.join(r.to_bytes(2, 'big') for r in regs)
+        reply = body + protocol.crc16(body).to_bytes(2, 'little')
+        roll = self.rng.random()
+        if roll < self.drop:
+            return None
+        roll -= self.drop
+        if roll < self.truncate:
+            return reply[:self.rng.randint(1, len(reply) - 1)]
+        roll -= self.truncate
+        if roll < self.corrupt:
+            return reply[:-1] + bytes((reply[-1] ^ 0xFF,))
+        return reply
+
+    def respond(self, request, write):
+        seen = time.monotonic()
+        reply = self.handle(request)
+        if reply is not None:
+            delay = self.latency + self.rng.uniform(0, self.jitter)
+            if delay:
+                time.sleep(delay)
+            write(reply)
+        with self.lock:
+            self.log.append((seen, time.monotonic() if reply is not None else None,
+                             request[0], int.from_bytes(request[2:4], 'big')))
+
+def read_request(read):
+    """One 8 byte function 0x03 request, b'' once the peer is gone."""
+    buf = b''
+    while len(buf) < 8:
+        chunk = read(8 - len(buf))
+        if not chunk:
+            return b''
+        buf += chunk
+    return buf
+
+def serve_tcp(stack, host='127.0.0.1', port=50500):
+    """Start a threaded TCP server, returns the bound port."""
+    srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    srv.bind((host, port))
+    srv.listen()
+    def client(conn):
+        with conn:
+            while True:
+                try:
+                    request = read_request(conn.recv)
+                except OSError:
+                    return
+                if not request:
+                    return
+                stack.respond(request, conn.sendall)
+    def accept():
+        while True:
+            conn, _ = srv.accept()
+            conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            threading.Thread(target=client, args=(conn,), daemon=True).start()
+    threading.Thread(target=accept, daemon=True).start()
+    return srv.getsockname()[1]
+
+def serve_pty(stack):
+    """Serve on a pseudo terminal, returns the device path to use as serial_port."""
+    import tty
+    master, slave = os.openpty()
+    tty.setraw(slave)
+    def loop():
+        while True:
+            request = read_request(lambda n: os.read(master, n))
+            if not request:
+                return
+            stack.respond(request, lambda data: os.write(master, data))
+    threading.Thread(target=loop, daemon=True).start()
+    return os.ttyname(slave)
+
+def main():
+    parser = argparse.ArgumentParser(description='Ritar BMS Modbus simulator')
+    parser.add_argument('--batteries', type=int, default=1, help='simulate batteries 1..N (16 is address 0)')
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=50500)
+    parser.add_argument('--pty', action='store_true', help='serve on a pseudo terminal instead of TCP')
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds before every reply')
+    parser.add_argument('--jitter', type=float, default=0.0, help='extra random seconds, uniform 0..jitter')
+    parser.add_argument('--drop', type=float, default=0.0, help='probability a reply is not sent')
+    parser.add_argument('--truncate', type=float, default=0.0, help='probability a reply is cut short')
+    parser.add_argument('--corrupt', type=float, default=0.0, help='probability of a bad CRC')
+    parser.add_argument('--seed', type=int)
+    args = parser.parse_args()
+
+    stack = SimulatedStack(
+        [protocol.battery_address(i) for i in range(1, args.batteries + 1)],
+        args.latency, args.jitter, args.drop, args.truncate, args.corrupt, args.seed
+    )
+    if args.pty:
+        print(f"Simulating {args.batteries} batteries on {serve_pty(stack)}")
+    else:
+        print(f"Simulating {args.batteries} batteries on {args.host}:{serve_tcp(stack, args.host, args.port)}")
+    try:
+        while True:
+            time.sleep(3600)
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == '__main__':
+    main()
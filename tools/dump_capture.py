@@ -0,0 +1,37 @@
+#!/usr/bin/env python3
+# dump_capture.py
+#
+# Prints a raw frame capture (capture: true) as one line per exchange:
+# wall clock time, address, status, register window and the frames in hex.
+#
+#   python3 tools/dump_capture.py /data/capture/capture.bin
+
+import argparse
+import datetime
+import os
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import capture
+
+def main():
+    parser = argparse.ArgumentParser(description='Print a Ritar BMS frame capture')
+    parser.add_argument('path')
+    parser.add_argument('--address', type=int, help='only this Modbus address')
+    args = parser.parse_args()
+
+    with open(args.path, 'rb') as f:
+        _, version, wall, mono = capture.FILE_HEADER.unpack(f.read(capture.FILE_HEADER.size))
+    counts = dict.fromkeys(capture.STATUS, 0)
+    for t, addr, status, request, reply in capture.read_records(args.path):
+        if args.address is not None and addr != args.address:
+            continue
+        counts[capture.STATUS[status]] += 1
+        when = datetime.datetime.fromtimestamp(wall + t - mono).isoformat(timespec='milliseconds')
+        window = f"0x{int.from_bytes(request[2:4], 'big'):04x}+{int.from_bytes(request[4:6], 'big')}"
+        print(f"{when} addr {addr:2d} {window:10s} {capture.STATUS[status]:11s} {request.hex()} -> {reply.hex()}")
+    print(', '.join(f"{k}: {v}" for k, v in counts.items()))
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,85 @@
+# mqtt_standin.py
+#
+# Minimal MQTT 3.1.1 broker stand-in for benchmarks: accepts any client,
+# acknowledges everything and records every PUBLISH it receives. Nothing is
+# routed to subscribers.
+
+import socket
+import threading
+import time
+
+class MqttStandIn:
+    def __init__(self, host='127.0.0.1', port=0):
+        self.lock = threading.Lock()
+        # (monotonic time, topic, payload length, retain)
+        self.messages = []
+        self._srv = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._srv.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._srv.bind((host, port))
+        self._srv.listen()
+        self.port = self._srv.getsockname()[1]
+        threading.Thread(target=self._accept, daemon=True).start()
+
+    def _accept(self):
+        while True:
+            conn, _ = self._srv.accept()
+            threading.Thread(target=self._client, args=(conn,), daemon=True).start()
+
+    @staticmethod
+    def _read_exact(conn, n):
+        buf = b''
+        while len(buf) < n:
+            chunk = conn.recv(n - len(buf))
+            if not chunk:
+                raise ConnectionError
+            buf += chunk
+        return buf
+
+    def _packet(self, conn):
+        head = self._read_exact(conn, 1)[0]
+        length, shift = 0, 0
+        while True:
+            b = self._read_exact(conn, 1)[0]
+            length |= (b & 0x7F) << shift
+            shift += 7
+            if not b & 0x80:
+                break
+        return head, self._read_exact(conn, length) if length else b''
+
+    def _client(self, conn):
+        try:
+            with conn:
+                while True:
+                    head, body = self._packet(conn)
+                    kind = head >> 4
+                    if kind == 1:        # CONNECT
+                        conn.sendall(b'\x20\x02\x00\x00')
+                    elif kind == 3:      # PUBLISH
+                        qos = (head >> 1) & 3
+                        tlen = int.from_bytes(body[:2], 'big')
+                        topic = body[2:2 + tlen].decode()
+                        pos = 2 + tlen
+                        pid = body[pos:pos + 2]
+                        if qos:
+                            pos += 2
+                        with self.lock:
+                            self.messages.append((time.monotonic(), topic, len(body) - pos, bool(head & 1)))
+                        if qos == 1:
+                            conn.sendall(b'\x40\x02' + pid)
+                        elif qos == 2:
+                            conn.sendall(b'\x50\x02' + pid)
+                    elif kind == 6:      # PUBREL
+                        conn.sendall(b'\x70\x02' + body[:2])
+                    elif kind == 8:      # SUBSCRIBE
+                        topics = 0
+                        pos = 2
+                        while pos < len(body):
+                            pos += 2 + int.from_bytes(body[pos:pos + 2], 'big') + 1
+                            topics += 1
+                        conn.sendall(bytes((0x90, 2 + topics)) + body[:2] + b'\x00' * topics)
+                    elif kind == 12:     # PINGREQ
+                        conn.sendall(b'\xd0\x00')
+                    elif kind == 14:     # DISCONNECT
+                        return
+        except (ConnectionError, OSError):
+            pass
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+# replay_sniffer.py
+#
+# Replays a byte stream through the listen-only RTU parser. Either a raw
+# capture of the bus (e.g. `cat /dev/ttyUSB0 > bus.bin`) or a synthetic
+# stream of inverter style polling with dropped, cut and corrupted replies
+# and line noise, chopped into random chunks like a TCP gate delivers them.
+# For synthetic streams every recovered exchange is checked against what
+# was sent; the parser's speed is reported as the baud rate it could follow.
+#
+#   python3 tools/replay_sniffer.py --exchanges 20000 --noise 0.02
+#   python3 tools/replay_sniffer.py --capture bus.bin --baud 9600
+
+import argparse
+import os
+import random
+import sys
+import time
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import protocol
+import register_map
+from read_planner import split_response
+from rtu_sniffer import RtuParser, MAX_BUFFER, covered_windows
+from bms_simulator import SimulatedStack
+
+def synthetic_stream(args, rng):
+    """(chunks as (time, bytes), expected exchanges as (addr, start, count, reply))."""
+    stack = SimulatedStack(range(1, args.batteries + 1), drop=args.drop, truncate=args.truncate,
+                           corrupt=args.corrupt, seed=args.seed)
+    windows = list(protocol.QUERY_WINDOWS.values()) + [(0x0000, 60)]  # plus an inverter sized read
+    char = 11.0 / args.baud
+    wire = bytearray()
+    marks = []  # (byte offset, line silence before it)
+    expected = []
+    for _ in range(args.exchanges):
+        addr = rng.randint(1, args.batteries)
+        start, count = rng.choice(windows)
+        request = protocol.build_read(addr, start, count)
+        reply = stack.handle(request) or b''
+        if rng.random() < args.noise:
+            marks.append((len(wire), 0.1))
+            wire += bytes(rng.randrange(256) for _ in range(rng.randint(1, 40)))
+        marks.append((len(wire), 0.1))
+        wire += request
+        marks.append((len(wire), 0.02))
+        wire += reply
+        if len(reply) == protocol.response_len(count) and protocol.validate_response(reply, addr, count):
+            expected.append((addr, start, count, reply))
+    # Deliver in random chunks, a silence only ever falls on a frame boundary
+    chunks = []
+    t = 0.0
+    pos = 0
+    boundaries = dict(marks)
+    while pos < len(wire):
+        size = rng.randint(1, 64)
+        end = min(len(wire), pos + size)
+        for i in range(pos + 1, end):
+            if i in boundaries:
+                end = i
+                break
+        t += boundaries.get(pos, 0) + char * (end - pos)
+        chunks.append((t, bytes(wire[pos:end])))
+        pos = end
+    return chunks, expected
+
+def read_capture(path, baud):
+    with open(path, 'rb') as f:
+        data = f.read()
+    char = 11.0 / baud
+    return [(i * char, data[i:i + 256]) for i in range(0, len(data), 256)], None
+
+def main():
+    parser = argparse.ArgumentParser(description='Replay bus traffic through the RTU sniffer')
+    parser.add_argument('--capture', help='raw bus capture file instead of a synthetic stream')
+    parser.add_argument('--baud', type=int, default=9600)
+    parser.add_argument('--batteries', type=int, default=4)
+    parser.add_argument('--exchanges', type=int, default=5000)
+    parser.add_argument('--drop', type=float, default=0.02)
+    parser.add_argument('--truncate', type=float, default=0.02)
+    parser.add_argument('--corrupt', type=float, default=0.02)
+    parser.add_argument('--noise', type=float, default=0.01, help='probability of junk bytes before a request')
+    parser.add_argument('--seed', type=int, default=1)
+    args = parser.parse_args()
+
+    if args.capture:
+        chunks, expected = read_capture(args.capture, args.baud)
+    else:
+        chunks, expected = synthetic_stream(args, random.Random(args.seed))
+    total = sum(len(c) for _, c in chunks)
+
+    rtu = RtuParser(11.0 / args.baud, max(10 * 3.5 * 11.0 / args.baud, 0.01))
+    found = []
+    peak = 0
+    started = time.perf_counter()
+    for t, chunk in chunks:
+        found.extend(rtu.feed(chunk, t))
+        peak = max(peak, len(rtu.buf))
+    elapsed = time.perf_counter() - started
+
+    decoded = 0
+    for addr, start, count, reply in found:
+        parts = covered_windows(register_map.MAP.ranges, start, count)
+        if any(name == 'block_voltage' for name, _, _ in parts):
+            # The same path the add-on takes, counting block voltage decodes
+            values, _ = register_map.MAP.decode(split_response(addr, start, parts, reply, count))
+            if values.get('voltage') is not None:
+                decoded += 1
+
+    print(f"Bytes          : {total} in {len(chunks)} chunks")
+    print(f"Frames         : {rtu.frames}, {len(found)} request/reply pairs, {decoded} block voltage decodes")
+    print(f"Resync skipped : {rtu.dropped} bytes, peak buffer {peak} bytes (bound {MAX_BUFFER})")
+    if expected is not None:
+        missed = Counter(expected) - Counter(found)
+        wrong = Counter(found) - Counter(expected)
+        print(f"Expected pairs : {len(expected)}, missed {sum(missed.values())}, wrong {sum(wrong.values())}")
+    rate = total / elapsed
+    print(f"Parser speed   : {rate / 1024:.0f} KiB/s, keeps up with {rate * 11:,.0f} baud")
+
+if __name__ == '__main__':
+    main()